@@ -0,0 +1,103 @@
+import shutil
+import tempfile
+from pathlib import Path
+from h5py import File as HDFFile
+
+from .synthetic import make_nuc
+
+class NucBenchmark:
+    # Generates a synthetic .nuc file for each combination of params
+    params = ([10, 100], [1000, 10000])
+    param_names = ['models', 'particles']
+    chromosomes = 4
+    restraint_density = 1.0
+    timeout = 300
+
+    def setup(self, models, particles):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.nuc = make_nuc(self.tmpdir / "bench.nuc", models=models,
+                            chromosomes=self.chromosomes, particles=particles,
+                            restraint_density=self.restraint_density,
+                            chunks=(1, particles, 3))
+
+    def teardown(self, models, particles):
+        shutil.rmtree(str(self.tmpdir))
+
+class Align(NucBenchmark):
+    def time_align(self, models, particles):
+        from nuc_analyze.align import align
+        align.main([str(self.nuc)], standalone_mode=False)
+
+    def time_align_median(self, models, particles):
+        from nuc_analyze.align import align
+        align.main([str(self.nuc), "--target", "median"], standalone_mode=False)
+
+    def peakmem_align(self, models, particles):
+        from nuc_analyze.align import align
+        align.main([str(self.nuc)], standalone_mode=False)
+
+class RMSD(NucBenchmark):
+    def time_rmsd(self, models, particles):
+        from nuc_analyze.rmsd import file_rmsd
+        file_rmsd(self.nuc)
+
+    def peakmem_rmsd(self, models, particles):
+        from nuc_analyze.rmsd import file_rmsd
+        file_rmsd(self.nuc)
+
+class Stats(NucBenchmark):
+    params = ([10, 100], [1000, 10000], [0.1, 1.0])
+    param_names = ['models', 'particles', 'restraint_density']
+
+    def setup(self, models, particles, restraint_density):
+        self.restraint_density = restraint_density
+        super().setup(models, particles)
+
+    def teardown(self, models, particles, restraint_density):
+        super().teardown(models, particles)
+
+    def time_violations(self, models, particles, restraint_density):
+        from nuc_analyze.stats import violations
+        with HDFFile(str(self.nuc), "r") as f:
+            violations(f)
+
+    def peakmem_violations(self, models, particles, restraint_density):
+        from nuc_analyze.stats import violations
+        with HDFFile(str(self.nuc), "r") as f:
+            violations(f)
+
+    def time_scale(self, models, particles, restraint_density):
+        from nuc_analyze.stats import scale
+        with HDFFile(str(self.nuc), "r") as f:
+            scale(f)
+
+    def peakmem_scale(self, models, particles, restraint_density):
+        from nuc_analyze.stats import scale
+        with HDFFile(str(self.nuc), "r") as f:
+            scale(f)
+
+class Linkage(NucBenchmark):
+    params = ([50, 200, 1000], [1000])
+
+    def time_linkage(self, models, particles):
+        from nuc_analyze.cluster import linkage
+        linkage(self.nuc, "0")
+
+    def peakmem_linkage(self, models, particles):
+        from nuc_analyze.cluster import linkage
+        linkage(self.nuc, "0")
+
+class Startup:
+    def timeraw_help(self):
+        return """
+        from nuc_analyze.main import cli
+        try:
+            cli(['--help'])
+        except SystemExit:
+            pass
+        """
+
+    def timeraw_import_all(self):
+        return """
+        from nuc_analyze import align, cluster, rmsd, stats
+        """
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from h5py import File as HDFFile
+import numpy as np
+import click
+
+Restraint = np.dtype([('indices', 'int32', 2), ('dists', 'float32', 2)])
+
+def make_nuc(path, models=10, chromosomes=2, particles=1000, restraint_density=1.0,
+             chunks=None, particle_size=100000, noise=0.5, seed=0):
+    # Write a .nuc file with one structure of random-walk chromosomes. Each model
+    # is a rotated and perturbed copy of the same underlying structure, and there
+    # are restraint_density restraints per particle for each pair of chromosomes.
+    rng = np.random.RandomState(seed)
+    chromos = [str(i + 1) for i in range(chromosomes)]
+    base = {chromo: np.cumsum(rng.normal(size=(particles, 3)), axis=0) + rng.normal(scale=10, size=3)
+            for chromo in chromos}
+    rotations = np.linalg.qr(rng.normal(size=(models, 3, 3)))[0]
+
+    with HDFFile(str(path), "w") as f:
+        structure = f.create_group("structures/0")
+        calculation = structure.create_group("calculation")
+        calculation.attrs['particle_sizes'] = np.array([8000000, particle_size])
+        calculation.attrs['models'] = models
+        for chromo in chromos:
+            coords = base[chromo] + rng.normal(scale=noise, size=(models, particles, 3))
+            coords = coords @ rotations.transpose(0, 2, 1)
+            structure.create_dataset("coords/{}".format(chromo), data=coords, chunks=chunks)
+            structure.create_dataset("particles/{}/positions".format(chromo),
+                                     data=np.arange(particles, dtype='int64') * particle_size)
+
+        nrestraints = int(restraint_density * particles)
+        for i, chr_a in enumerate(chromos):
+            for chr_b in chromos[i:]:
+                if not nrestraints:
+                    continue
+                a = rng.randint(particles, size=nrestraints)
+                if chr_a == chr_b:
+                    # Mostly short-range contacts within a chromosome
+                    b = np.clip(a + rng.geometric(0.05, size=nrestraints), 0, particles - 1)
+                else:
+                    b = rng.randint(particles, size=nrestraints)
+                restraints = np.empty(nrestraints, dtype=Restraint)
+                restraints['indices'] = np.stack([a, b], axis=-1)
+                dist = np.linalg.norm(base[chr_a][a] - base[chr_b][b], axis=-1)
+                restraints['dists'] = np.stack([dist * 0.8, dist * 1.2], axis=-1)
+                structure.create_dataset("restraints/{}/{}".format(chr_a, chr_b), data=restraints)
+    return path
+
+@click.command()
+@click.argument("output", type=Path)
+@click.option("--models", type=int, default=10)
+@click.option("--chromosomes", type=int, default=2)
+@click.option("--particles", type=int, default=1000, help="Particles per chromosome")
+@click.option("--restraint-density", type=float, default=1.0,
+              help="Restraints per particle for each pair of chromosomes")
+@click.option("--chunks", type=(int, int, int), default=None)
+@click.option("--seed", type=int, default=0)
+def main(output, models, chromosomes, particles, restraint_density, chunks, seed):
+    make_nuc(output, models=models, chromosomes=chromosomes, particles=particles,
+             restraint_density=restraint_density, chunks=chunks, seed=seed)
+
+if __name__ == "__main__":
+    main()
@@ -1 +0,0 @@
-from . import main, rmsd, stats, cluster, align
@@ -2,26 +2,100 @@
 from pathlib import Path
 from h5py import File as HDFFile
 import numpy as np
-import operator as op
-from functools import partial
 import click
-from coherent_point_drift.least_squares import align as least_squares
 
 from .main import cli
+from .timings import stage, file as timed_file
+from .nucfile import NucFile, slabs, slab_size, structure_names, precision_option, read
+
+def kabsch(covariance, mirror=True):
+    """Optimal rotations for a stack of ``(..., 3, 3)`` cross-covariance matrices.
+
+    If ``mirror`` is set, improper rotations (reflections) are also allowed.
+    """
+    U, _, VT = np.linalg.svd(covariance)
+    if not mirror:
+        U[..., :, -1] *= np.sign(np.linalg.det(U @ VT))[..., None]
+    return U @ VT
+
+def superpose(ref, coords, mirror=True):
+    """Rigid transforms superposing each model in ``coords`` onto ``ref``.
+
+    Returns a ``(models, 3, 3)`` stack of rotations and a ``(models, 3)`` stack
+    of translations, to be applied with :func:`transform`.
+    """
+    ref_mean = np.mean(ref, axis=0)
+    coords_mean = np.mean(coords, axis=1)
+    covariance = np.einsum('pi,mpj->mij', ref - ref_mean, coords - coords_mean[:, None])
+    rotations = kabsch(covariance, mirror=mirror)
+    translations = ref_mean - np.einsum('mij,mj->mi', rotations, coords_mean)
+    return rotations, translations
+
+def transform(coords, rotations, translations):
+    result = coords @ rotations.transpose(0, 2, 1)
+    result += translations[:, None]
+    return result
+
+def particle_slabs(coords, budget=None):
+    # Slices of particles taking at most budget bytes, or all particles if None.
+    # Each slab is read along with one array of the same size (its median, or
+    # its transformed coordinates), so each takes half the budget.
+    return slabs(coords, axis=1, size=None if budget is None else slab_size(coords, 1, budget / 2))
+
+def fit(coordss, target="0", mirror=True, budget=None, dtype='double'):
+    # As superpose, but accumulates the covariance one slab of particles at a
+    # time so the coordinates are never all in memory at once. Slabs are read
+    # as dtype, but accumulated in double.
+    models = next(iter(coordss.values())).shape[0]
+    cross = np.zeros((models, 3, 3))
+    coords_sum = np.zeros((models, 3))
+    ref_sum = np.zeros(3)
+    n = 0
+
+    for coords in coordss.values():
+        if target != 'median':
+            with stage("read"):
+                target_coords = read(coords, int(target), dtype)
+        for s in particle_slabs(coords, budget):
+            with stage("read"):
+                slab = read(coords, np.s_[:, s], dtype)
+            with stage("covariance"):
+                if target == 'median':
+                    ref = np.median(slab, axis=0)
+                else:
+                    ref = target_coords[s]
+                cross += np.einsum('pi,mpj->mij', ref, slab)
+                coords_sum += np.sum(slab, axis=1)
+                ref_sum += np.sum(ref, axis=0)
+                n += slab.shape[1]
+
+    with stage("superpose"):
+        ref_mean = ref_sum / n
+        coords_mean = coords_sum / n
+        covariance = cross - n * ref_mean[:, None] * coords_mean[:, None, :]
+        rotations = kabsch(covariance, mirror=mirror)
+        translations = ref_mean - np.einsum('mij,mj->mi', rotations, coords_mean)
+    return rotations, translations
 
 @cli.command()
 @click.argument("nuc", type=Path, required=True)
 @click.option("--target", default="0", help="Which model to align to")
-@click.option("--structure", default="0", help="Which structure in the file to read")
+@click.option("--structure", default="0",
+              help="Which structure in the file to align ('all', or a comma-separated list)")
 @click.option("--mirror/--no-mirror", default=True, help="Also align mirror images")
-def align(nuc, target, structure, mirror=True):
-    with HDFFile(nuc, "r+") as f:
-        coordss = f['structures'][structure]['coords']
-        all_coords = np.concatenate(list(coordss.values()), axis=1)
-        if target == 'median':
-            ref = np.median(all_coords, axis=0)
-        else:
-            ref = all_coords[int(target)]
-        xforms = list(map(partial(least_squares, ref, mirror=mirror), all_coords))
-        for chr, coords in coordss.items():
-            coords[:] = np.array(list(map(op.matmul, xforms, coords)), dtype=coords.dtype)
+@click.option("--memory-budget", type=float, default=None,
+              help="Read coordinates in slabs taking at most this many MiB to align")
+@precision_option
+def align(nuc, target, structure, mirror=True, memory_budget=None, precision="float64"):
+    budget = None if memory_budget is None else memory_budget * 2 ** 20
+    with HDFFile(str(nuc), "r+") as f, timed_file(nuc):
+        for structure in structure_names(f, structure):
+            nucfile = NucFile(f, structure)
+            with stage("fit"):
+                # From the exported sidecar if there is one (which this makes stale)
+                rotations, translations = fit(nucfile.arrays, target, mirror=mirror, budget=budget,
+                                              dtype=precision)
+            with stage("transform"):
+                for chr, coords in nucfile.datasets.items():
+                    for s in particle_slabs(coords, budget):
+                        coords[:, s] = transform(coords[:, s], rotations, translations)
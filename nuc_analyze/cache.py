@@ -0,0 +1,93 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+# Bump when the format of cached results changes
+VERSION = 1
+
+class Cache:
+    # On-disk store of results computed from .nuc files, keyed by the file's
+    # identity and the function and arguments used. Least recently used entries
+    # are evicted once the total size exceeds max_size bytes.
+    def __init__(self, path, max_size=2 ** 30):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    def key(self, f, nuc, args, kwargs):
+        stat = os.stat(str(nuc))
+        ident = (VERSION, str(Path(nuc).resolve()), stat.st_size, stat.st_mtime_ns,
+                 f.__module__, f.__qualname__, args, sorted(kwargs.items()))
+        return hashlib.sha256(repr(ident).encode()).hexdigest()
+
+    def entries(self):
+        if not self.path.is_dir():
+            return []
+        return list(self.path.glob("*.pickle"))
+
+    def get(self, key):
+        path = self.path / "{}.pickle".format(key)
+        try:
+            with path.open("rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:
+            # Evicted by another process since it was read
+            pass
+        return value
+
+    def put(self, key, value):
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / "{}.pickle".format(key)
+        tmp = path.with_suffix(".tmp{}".format(os.getpid()))
+        with tmp.open("wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp), str(path))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path in self.entries():
+            path.unlink()
+
+    def __call__(self, f, nuc, *args, **kwargs):
+        key = self.key(f, nuc, args, kwargs)
+        try:
+            return self.get(key)
+        except KeyError:
+            pass
+        value = f(nuc, *args, **kwargs)
+        self.put(key, value)
+        return value
+
+def cached(cache, f, nuc, *args, **kwargs):
+    # Call f(nuc, *args, **kwargs), looking the result up in cache if it is not None
+    if cache is None:
+        return f(nuc, *args, **kwargs)
+    return cache(f, nuc, *args, **kwargs)
+
+def current_cache():
+    import click
+
+    obj = click.get_current_context().find_root().obj
+    return (obj or {}).get('cache')
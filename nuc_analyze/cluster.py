@@ -1,30 +1,205 @@
 #!/usr/bin/env python3
 from pathlib import Path
-from h5py import File as HDFFile
 import numpy as np
-import operator as op
 import click
-from coherent_point_drift.least_squares import align
 from functools import partial
-from itertools import repeat, chain
+from itertools import chain
 from scipy.cluster import hierarchy
 
 from .main import cli
+from .cache import cached, current_cache
+from .timings import stage, file as timed_file
+from .nucfile import NucFile, precision_option
+from . import kernels, incremental
 
 def distance(x, y):
     x = x.reshape(-1, 3)
     y = y.reshape(-1, 3)
     return np.sqrt(np.mean((y - x) ** 2))
 
-def linkage(nuc, structure):
-    with HDFFile(nuc, "r") as f:
-        coords = np.concatenate(
-            list(f['structures'][structure]['coords'].values()), axis=1
-        )
-        return hierarchy.linkage(
-            coords.reshape(coords.shape[0], -1), method='single',
-            metric=distance
-        )
+linkage_methods = ['single', 'complete', 'average', 'weighted', 'centroid', 'median', 'ward']
+
+def flat_coords(coords):
+    # Models as rows, for RMSDs between them with kernels.rmsd_matrix. Single
+    # precision coordinates stay in single precision, anything else is converted
+    # to double.
+    coords = np.asarray(coords)
+    coords = coords.astype('single' if coords.dtype == np.single else 'double', copy=False)
+    coords = coords.reshape(coords.shape[0], -1)
+    # Shifting all models by the same amount leaves distances unchanged, but
+    # centering reduces cancellation error in the Gram formulation.
+    return np.ascontiguousarray(coords - np.mean(coords, axis=0))
+
+def pairwise_rmsd(coords, block_size=256, out=None):
+    # Equivalent to pdist(coords, metric=distance), computed in blocks of rows.
+    # The result is written to out if given (e.g. a memory-mapped array).
+    coords = flat_coords(coords)
+    n = len(coords)
+
+    if out is None:
+        out = np.empty(n * (n - 1) // 2, dtype='double')
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        dist = kernels.rmsd_matrix(coords[start:stop], coords[start:])
+        # Row i of the condensed matrix holds distances to models i+1..n-1, so
+        # a block of rows is contiguous and can be written at once
+        offset = n * start - start * (start + 1) // 2
+        rows = np.concatenate([dist[i - start, i - start + 1:] for i in range(start, stop)])
+        out[offset:offset + len(rows)] = rows
+    return out
+
+def extend_distances(old, coords, out, block_size=256):
+    # Write the condensed distance matrix of coords to out, given the condensed
+    # matrix old of its first models. Only distances to new models are computed.
+    n = len(coords)
+    stored = int(round((1 + np.sqrt(1 + 8 * len(old))) / 2))
+    coords = flat_coords(coords)
+    for start in range(0, stored, block_size):
+        stop = min(start + block_size, stored)
+        old_offset = stored * start - start * (start + 1) // 2
+        old_rows = old[old_offset:stored * stop - stop * (stop + 1) // 2]
+        new = kernels.rmsd_matrix(coords[start:stop], coords[stored:])
+        # Each row of the old matrix is followed by distances to the new models
+        old_offset = 0
+        rows = []
+        for i in range(start, stop):
+            length = stored - i - 1
+            rows.extend((old_rows[old_offset:old_offset + length], new[i - start]))
+            old_offset += length
+        offset = n * start - start * (start + 1) // 2
+        rows = np.concatenate(rows)
+        out[offset:offset + len(rows)] = rows
+    # Rows of the new models are the condensed matrix of those alone
+    if stored < n:
+        offset = n * stored - stored * (stored + 1) // 2
+        out[offset:] = pairwise_rmsd(coords[stored:], block_size)
+    return out
+
+def mst_linkage(coords):
+    # Single linkage from a minimum spanning tree (Prim's algorithm), computing
+    # the distances from each model as it is added instead of the full matrix
+    coords = flat_coords(coords)
+    n = len(coords)
+
+    in_tree = np.zeros(n, dtype='bool')
+    best = np.full(n, np.inf)
+    nearest = np.zeros(n, dtype='int')
+    edges = np.empty((n - 1, 3))
+    model = 0
+    for i in range(n - 1):
+        in_tree[model] = True
+        dist = kernels.rmsd_matrix(coords[model:model + 1], coords)[0]
+        closer = (dist < best) & ~in_tree
+        best[closer] = dist[closer]
+        nearest[closer] = model
+        best[model] = np.inf
+        model = np.argmin(best)
+        edges[i] = nearest[model], model, best[model]
+        best[model] = np.inf
+    return tree_linkage(edges, n)
+
+def tree_linkage(edges, n):
+    # Convert (a, b, distance) edges of a minimum spanning tree to a linkage
+    # matrix, labelling clusters as in scipy
+    edges = edges[np.argsort(edges[:, 2], kind='stable')]
+    parents = np.arange(2 * n - 1)
+    sizes = np.ones(2 * n - 1, dtype='int')
+
+    def find(x):
+        root = x
+        while parents[root] != root:
+            root = parents[root]
+        while parents[x] != root:
+            parents[x], x = root, parents[x]
+        return root
+
+    Z = np.empty((n - 1, 4))
+    for i, (a, b, dist) in enumerate(edges):
+        a, b = find(int(a)), find(int(b))
+        sizes[n + i] = sizes[a] + sizes[b]
+        Z[i] = min(a, b), max(a, b), dist, sizes[n + i]
+        parents[a] = parents[b] = n + i
+    return Z
+
+def structure_linkage(nucfile, method='single', scratch_dir=None):
+    # Single linkage never builds the full distance matrix. Otherwise it is
+    # computed in blocks, into a memory-mapped file in scratch_dir if given.
+    # scipy's linkage copies the matrix into memory regardless, so that only
+    # bounds the memory used computing it.
+    from tempfile import TemporaryFile
+
+    coords = nucfile.all_coords
+    if method == 'single':
+        with stage("linkage"):
+            return mst_linkage(coords)
+
+    n = len(coords)
+    with stage("distance"):
+        if scratch_dir is None:
+            distances = pairwise_rmsd(coords)
+        else:
+            scratch = TemporaryFile(dir=str(scratch_dir))
+            distances = np.memmap(scratch, dtype='double', mode='w+', shape=(n * (n - 1) // 2,))
+            pairwise_rmsd(coords, out=distances)
+    with stage("linkage"):
+        return hierarchy.linkage(distances, method=method)
+
+def stored_linkage(f, structure, method='single', scratch_dir=None, store=False,
+                   precision='float64'):
+    # Read the linkage from the file's analysis group if it was computed from the
+    # current coordinates. Otherwise compute it, and if store is set, save it
+    # with the distance matrix in the analysis group. If models have only been
+    # appended since, the stored distances are extended rather than recomputed.
+    nucfile = NucFile(f, structure, dtype=precision)
+    path = "analysis/clusters/{}/{}".format(structure, method)
+    # Sampled models are hashed rather than all coordinates, as in rmsd --store
+    with stage("hash"):
+        old, stored = incremental.stored(f, path, nucfile)
+    if old is not None and stored == nucfile.nmodels and 'linkage' in old:
+        with stage("read"):
+            return old['linkage'][:]
+    if not store:
+        return structure_linkage(nucfile, method, scratch_dir)
+    incremental.require_writable(f)
+
+    if old is None or 'distances' not in old:
+        old = None
+    group = f.require_group(path)
+    group.attrs.clear()
+    for name in ('linkage', 'new_distances'):
+        if name in group:
+            del group[name]
+    coords = nucfile.all_coords
+    n = len(coords)
+    with stage("distance"):
+        distances = group.create_dataset('new_distances', shape=(n * (n - 1) // 2,), dtype='double')
+        if old is not None:
+            extend_distances(old['distances'], coords, distances)
+        else:
+            pairwise_rmsd(coords, out=distances)
+    if 'distances' in group:
+        del group['distances']
+    group.move('new_distances', 'distances')
+    with stage("linkage"):
+        # As in structure_linkage, other methods need the whole matrix in memory
+        Z = mst_linkage(coords) if method == 'single' else hierarchy.linkage(distances[:], method=method)
+    group.create_dataset('linkage', data=Z)
+    # Written last, so an interrupted store is never mistaken for a valid one
+    incremental.tag(group, nucfile)
+    return Z
+
+def file_linkages(nuc, structures=("0",), method='single', scratch_dir=None, store=False,
+                  precision='float64'):
+    # Linkage of each structure in a .nuc file at path nuc
+    def structure_linkages(f):
+        return [(structure, stored_linkage(f, structure, method, scratch_dir, store, precision))
+                for structure in structures]
+    with timed_file(nuc):
+        return incremental.with_file(nuc, structure_linkages, store)
+
+def linkage(nuc, structure, method='single', scratch_dir=None, store=False, precision='float64'):
+    (_, Z), = file_linkages(nuc, (structure,), method, scratch_dir, store, precision)
+    return Z
 
 @cli.command()
 @click.argument("nucs", type=Path, nargs=-1)
@@ -32,22 +207,56 @@ def linkage(nuc, structure):
 @click.option("--output", help="Where to save the plot")
 @click.option("--figsize", type=(float, float), default=(8, 6),
               help="The size of the figure (in inches)")
-@click.option("--structure", default="0", help="Which structure in the file to read")
-def plot_clusters(nucs, title, output, figsize, structure):
+@click.option("--structure", default="0",
+              help="Which structure in the file to read ('all', or a comma-separated list)")
+@click.option("--jobs", type=int, default=1, help="How many files to process in parallel")
+@click.option("--method", type=click.Choice(linkage_methods), default='single',
+              help="How to calculate the distance between clusters")
+@click.option("--scratch-dir", type=Path,
+              help="Compute distance matrices into memory-mapped files in this directory "
+                   "(linkage still reads them into memory, except for single linkage, "
+                   "which never builds them)")
+@click.option("--store/--no-store", default=False,
+              help="Save the linkage and distance matrix in the file, for reuse by later plots")
+@click.option("--max-leaves", type=int, default=100,
+              help="Merge the lowest clusters to show at most this many leaves (0 for all)")
+@precision_option
+def plot_clusters(nucs, title, output, figsize, structure, jobs, method, scratch_dir, store,
+                  max_leaves, precision):
     import matplotlib
-    colors = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+    from matplotlib.colors import to_hex
+    # scipy requires a color string, but the cycle may contain RGB tuples
+    color = to_hex(matplotlib.rcParams['axes.prop_cycle'].by_key()['color'][0])
     if output is not None:
         matplotlib.use('Agg')
     import matplotlib.pyplot as plt
+    from .util import parallel_starmap
+    from .nucfile import structure_tasks, multiple_structures
 
-    fig, (axs,) = plt.subplots(1, len(nucs), figsize=figsize, squeeze=False, sharey=True)
+    # Structures of a file can't be written to from several processes at once
+    tasks = list(structure_tasks(nucs, structure, 1 if store else jobs))
+    nplots = sum(len(structures) for _, structures in tasks)
+    fig, (axs,) = plt.subplots(1, nplots, figsize=figsize, squeeze=False, sharey=True)
     height = 0.
-    for nuc, ax in zip(nucs, axs):
-        Z = linkage(nuc, structure=structure)
+    Zs = chain.from_iterable(parallel_starmap(
+        partial(cached, current_cache(), file_linkages, method=method, scratch_dir=scratch_dir,
+                store=store, precision=precision),
+        tasks, jobs
+    ))
+    for (structure_name, Z), ax in zip(Zs, axs):
         height = max(height, max(Z[:, 2]) * 1.05)
-        hierarchy.dendrogram(Z, ax=ax, link_color_func=lambda i: colors[0])
+        with stage("plot"):
+            truncate = {}
+            if max_leaves and len(Z) + 1 > max_leaves:
+                truncate = {'truncate_mode': 'lastp', 'p': max_leaves}
+            hierarchy.dendrogram(Z, ax=ax, link_color_func=lambda i: color, **truncate)
+            # Keep vector output small however many links there are
+            for artist in ax.collections:
+                artist.set_rasterized(True)
         ax.set_ylim((0, height))
         ax.set_xlabel("model")
+        if multiple_structures(structure):
+            ax.set_title("structure {}".format(structure_name))
     axs[0].set_ylabel("RMSD")
     if title:
         for ax, title in zip(axs, title):
@@ -56,5 +265,6 @@ def plot_clusters(nucs, title, output, figsize, structure):
     if output is None:
         plt.show()
     else:
-        fig.tight_layout()
-        fig.savefig(str(output))
+        with stage("save"):
+            fig.tight_layout()
+            fig.savefig(str(output))
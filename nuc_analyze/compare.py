@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from h5py import File as HDFFile
+import numpy as np
+import click
+
+from .main import cli
+from .timings import stage, file as timed_file
+from .nucfile import NucFile, precision_option
+from . import kernels
+
+def shared_particles(a, b):
+    # Indices of particles at positions in both NucFiles, by chromosome
+    shared = {}
+    for chromo in a.chromosomes:
+        if chromo not in b.chromosomes:
+            continue
+        _, idx_a, idx_b = np.intersect1d(a.positions(chromo), b.positions(chromo),
+                                         return_indices=True)
+        if len(idx_a):
+            shared[chromo] = idx_a, idx_b
+    return shared
+
+def model_tiles(nucfile, particles, size):
+    # (models, coords) of tiles of models, of the given particles of each chromosome
+    for start in range(0, nucfile.nmodels, size):
+        models = slice(start, min(start + size, nucfile.nmodels))
+        tile = nucfile.select(chromosomes=list(particles), models=models)
+        with stage("read"):
+            coords = np.concatenate([tile.coords(chromo)[:, idx]
+                                     for chromo, idx in particles.items()], axis=1)
+        # Don't keep the whole chromosomes read while the tile is used
+        del tile
+        yield models, coords
+
+def tile_row(nucfile, particles):
+    # Bytes per model of a tile: whole chromosomes are read before taking the
+    # particles, which are then copied again (concatenated, then centered)
+    read = sum(nucfile.datasets[chromo].shape[1] for chromo in particles)
+    shared = sum(len(idx) for idx in particles.values())
+    return (read + 2 * shared) * 3 * nucfile.dtype.itemsize
+
+# Bytes per pair of models of the RMSD matrix and kernel temporaries: two
+# values, or about 20 with superposition (covariances, their copy in the SVD,
+# singular values and squared distances)
+pair_values = {False: 2, True: 20}
+
+def tile_size(a, particles_a, b, particles_b, budget=None, superpose=False):
+    # How many models of a and of b to take in each tile, so that a tile of
+    # each and the RMSDs between them take at most budget bytes in total
+    if budget is None:
+        return 256, 256
+    row_a, row_b = tile_row(a, particles_a), tile_row(b, particles_b)
+    pair = pair_values[superpose] * max(a.dtype.itemsize, b.dtype.itemsize)
+    # Square tiles solve size * (row_a + row_b) + size ** 2 * pair = budget...
+    size = (np.sqrt((row_a + row_b) ** 2 + 4 * pair * budget) - (row_a + row_b)) / (2 * pair)
+    size_a = min(max(int(size), 1), a.nmodels)
+    # ...and if a has fewer models than that, b's tiles can take the rest
+    size_b = (budget - size_a * row_a) / (row_b + size_a * pair)
+    size_b = min(max(int(size_b), 1), b.nmodels)
+    return size_a, size_b
+
+def cross_rmsd(a, b, out, superpose=False, mirror=True, budget=None):
+    # Write the RMSD between each model of NucFile a and each of b, over the
+    # particles they share, to the (a models, b models) array out
+    shared = shared_particles(a, b)
+    if not shared:
+        raise ValueError("The structures have no particles in common")
+    particles_a = {chromo: idx for chromo, (idx, _) in shared.items()}
+    particles_b = {chromo: idx for chromo, (_, idx) in shared.items()}
+    size_a, size_b = tile_size(a, particles_a, b, particles_b, budget, superpose)
+
+    origin = None
+    for rows, tile_a in model_tiles(a, particles_a, size_a):
+        if origin is None:
+            # Any common shift leaves distances unchanged, but reduces
+            # cancellation error in the Gram formulation
+            origin = np.mean(tile_a[0], axis=0)
+        for cols, tile_b in model_tiles(b, particles_b, size_b):
+            with stage("rmsd"):
+                if superpose:
+                    tile = kernels.superposed_rmsd_matrix(tile_a, tile_b, mirror=mirror)
+                else:
+                    tile = kernels.rmsd_matrix((tile_a - origin).reshape(len(tile_a), -1),
+                                               (tile_b - origin).reshape(len(tile_b), -1))
+            with stage("write"):
+                out[rows, cols] = tile
+            # Not kept while the next tile is computed
+            del tile
+    return out
+
+def open_output(path, shape):
+    # A .npy memory map, or an 'rmsd' dataset in a new HDF5 file (closed by the caller)
+    if path.suffix == ".npy":
+        return None, np.lib.format.open_memmap(str(path), mode='w+', dtype='double', shape=shape)
+    f = HDFFile(str(path), "w")
+    return f, f.create_dataset('rmsd', shape=shape, dtype='double',
+                               chunks=(min(shape[0], 256), min(shape[1], 256)))
+
+@cli.command("cross-rmsd")
+@click.argument("nuc_a", type=Path, required=True)
+@click.argument("nuc_b", type=Path, required=True)
+@click.option("--output", type=Path, required=True,
+              help="Where to write the matrix (.npy for a NumPy array, otherwise HDF5)")
+@click.option("--structure", default="0", help="Which structure in each file to compare")
+@click.option("--superpose/--no-superpose", default=False,
+              help="Optimally superpose each pair of models first")
+@click.option("--mirror/--no-mirror", default=True, help="Also superpose mirror images")
+@click.option("--memory-budget", type=float, default=None,
+              help="Compare models in tiles taking at most this many MiB (with their RMSDs)")
+@precision_option
+def output_cross_rmsd(nuc_a, nuc_b, output, structure, superpose, mirror, memory_budget,
+                      precision):
+    budget = None if memory_budget is None else memory_budget * 2 ** 20
+    with NucFile.open(nuc_a, structure, dtype=precision) as a, \
+         NucFile.open(nuc_b, structure, dtype=precision) as b:
+        f, out = open_output(output, (a.nmodels, b.nmodels))
+        try:
+            with timed_file(nuc_a):
+                cross_rmsd(a, b, out, superpose=superpose, mirror=mirror, budget=budget)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        finally:
+            if f is None:
+                out.flush()
+            else:
+                f.attrs['files'] = [str(nuc_a), str(nuc_b)]
+                f.attrs['structure'] = structure
+                f.attrs['superposed'] = superpose
+                f.close()
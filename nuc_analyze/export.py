@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+from pathlib import Path
+import click
+
+from .main import cli
+from .timings import file as timed_file
+from .nucfile import export_sidecar, structure_names
+
+@cli.command()
+@click.argument("nucs", type=Path, nargs=-1, required=True)
+@click.option("--structure", default="0",
+              help="Which structure in the file to export ('all', or a comma-separated list)")
+def export(nucs, structure):
+    # Other commands read the exported files instead of the .nuc file's
+    # coordinates until it is next modified
+    for nuc in nucs:
+        with timed_file(nuc):
+            for structure_name in structure_names(nuc, structure):
+                paths = export_sidecar(nuc, structure_name)
+                click.echo(str(paths['coords']))
@@ -0,0 +1,82 @@
+import numpy as np
+from h5py import File as HDFFile
+
+from .timings import stage
+
+# Partial results stored in a .nuc file's analysis group, tagged with the number
+# of models they cover. When models are appended to a structure, only the new
+# ones need processing before merging into the stored results.
+
+class ReadOnly(Exception):
+    # Stored results need updating, but the file is open read-only
+    pass
+
+def require_writable(f):
+    if f.file.mode != "r+":
+        raise ReadOnly(f.file.filename)
+
+def with_file(nuc, f, store=False):
+    # Call f with the .nuc file at path nuc open, read-only unless stored results
+    # need updating. Opening a file to write changes its mtime even if nothing
+    # is written, which would invalidate cached results and exported sidecars.
+    if store:
+        try:
+            with HDFFile(str(nuc), "r") as h:
+                return f(h)
+        except ReadOnly:
+            pass
+    with HDFFile(str(nuc), "r+" if store else "r") as h:
+        return f(h)
+
+def models_hash(nucfile, n):
+    # Cheap check that the first n models are unchanged: models are only ever
+    # appended, but align rewrites all of them (including the first and last)
+    from hashlib import sha1
+
+    if not n:
+        return ""
+    h = sha1()
+    for chromo, dataset in nucfile.datasets.items():
+        # Unlike NucFile.fingerprint, independent of how many models follow
+        h.update(repr((chromo, dataset.shape[1:])).encode())
+        with stage("read"):
+            h.update(np.ascontiguousarray(dataset[sorted({0, n - 1})], dtype='double').tobytes())
+    return h.hexdigest()
+
+def load(f, path, nucfile):
+    # The stored group at path and the number of models it covers, or (None, 0)
+    # if there is none, those models have changed or it was computed in another
+    # precision. Raises ReadOnly if it needs updating and f can't be written to.
+    group, n = stored(f, path, nucfile)
+    if n < nucfile.nmodels:
+        require_writable(f)
+    return group, n
+
+def stored(f, path, nucfile):
+    if path not in f:
+        return None, 0
+    group = f[path]
+    if group.attrs.get('dtype', 'float64') != nucfile.dtype.name:
+        return None, 0
+    n = int(group.attrs.get('nmodels', -1))
+    if not 0 <= n <= nucfile.nmodels or group.attrs.get('models_hash') != models_hash(nucfile, n):
+        return None, 0
+    return group, n
+
+def save(f, path, nucfile, **data):
+    # Replace the results at path with data covering all of nucfile's models
+    if path in f:
+        del f[path]
+    group = f.create_group(path)
+    for name, value in data.items():
+        group.create_dataset(name, data=value)
+    tag(group, nucfile)
+    return group
+
+def tag(group, nucfile):
+    group.attrs['dtype'] = nucfile.dtype.name
+    group.attrs['nmodels'] = nucfile.nmodels
+    group.attrs['models_hash'] = models_hash(nucfile, nucfile.nmodels)
+
+def kwargs_key(kwargs):
+    return ",".join("{}={!r}".format(k, v) for k, v in sorted(kwargs.items())) or "default"
@@ -0,0 +1,108 @@
+import os
+from importlib.util import find_spec
+import numpy as np
+
+# Numeric kernels of the hot loops, in plain NumPy and (if Numba is installed)
+# as compiled single-pass loops parallelized over cores, in numba_kernels.py.
+# Set NUC_ANALYZE_BACKEND to choose one explicitly. Call them as attributes
+# of this module, so that use() applies.
+
+# Kernels run in the precision of the coordinates they are given: double, or
+# single with --precision float32. In single precision (eps = 2 ** -23), the
+# error relative to double for the same stored coordinates is at most about:
+# - rmsd_matrix and superposed_rmsd_matrix: |d32 ** 2 - d64 ** 2| <=
+#   sqrt(3 * particles) * eps * (a2 + b2), where a2 and b2 are the mean squared
+#   (centered) coordinates of the two models. Distances much smaller than the
+#   structures themselves therefore lose most of their relative precision.
+# - slab_moments: a relative error in per-particle RMSDs of 8 * eps * (1 + |mean
+#   position| / RMSD) with NumPy. Numba accumulates in double, so is as
+#   accurate as in double precision.
+# - violation_counts: counts only differ for restraints whose distances are
+#   within 4 * eps (relative) of their padded bounds.
+# tests/test_kernels.py checks these bounds.
+
+def numpy_rmsd_matrix(a, b):
+    # RMSD between each row of a and each row of b, from the Gram matrix, with
+    # at most two (a rows, b rows) arrays at a time
+    sq = np.einsum('ij,ij->i', a, a)[:, None] + np.einsum('ij,ij->i', b, b)[None, :]
+    gram = a @ b.T
+    gram *= 2
+    sq -= gram
+    del gram
+    np.maximum(sq, 0.0, out=sq)
+    sq /= a.shape[1]
+    return np.sqrt(sq, out=sq)
+
+def numpy_superposed_rmsd_matrix(a, b, mirror=True):
+    # RMSD between each model of a and each model of b, both (models, particles,
+    # 3), after optimally superposing each pair. Only the singular values of the
+    # Kabsch covariance are needed, not the rotations themselves.
+    a = a - np.mean(a, axis=1, keepdims=True)
+    b = b - np.mean(b, axis=1, keepdims=True)
+    (na, particles, ndim), nb = a.shape, len(b)
+    # All pairs' covariances as one matrix product
+    covariance = (a.transpose(0, 2, 1).reshape(na * ndim, particles)
+                  @ b.transpose(1, 0, 2).reshape(particles, nb * ndim))
+    covariance = covariance.reshape(na, ndim, nb, ndim).transpose(0, 2, 1, 3)
+    s = np.linalg.svd(covariance, compute_uv=False)
+    if not mirror:
+        s[..., -1] *= np.sign(np.linalg.det(covariance))
+    sq = (np.einsum('ipk,ipk->i', a, a)[:, None] + np.einsum('ipk,ipk->i', b, b)[None, :]
+          - 2 * np.sum(s, axis=-1))
+    np.maximum(sq, 0.0, out=sq)
+    return np.sqrt(sq / (particles * ndim))
+
+def numpy_slab_moments(slab):
+    # Per-particle mean and sum of squared deviations (summed over dimensions)
+    # of a (models, particles, 3) slab
+    mean = np.mean(slab, axis=0)
+    return mean, np.sum((slab - mean) ** 2, axis=(0, 2))
+
+def numpy_violation_counts(a_coords, b_coords, indices, lower, upper, padding):
+    # Number of restraints between two chromosomes violated in each model
+    dist = np.linalg.norm(a_coords[:, indices[:, 0]] - b_coords[:, indices[:, 1]], axis=-1)
+    viol = (upper * (1.0 + padding) < dist) | (lower * (1.0 - padding) > dist)
+    return np.count_nonzero(viol, axis=1)
+
+backends = {'numpy': {
+    'rmsd_matrix': numpy_rmsd_matrix,
+    'superposed_rmsd_matrix': numpy_superposed_rmsd_matrix,
+    'slab_moments': numpy_slab_moments,
+    'violation_counts': numpy_violation_counts,
+}}
+
+if find_spec('numba') is not None:
+    # Imported and compiled only when first used, as importing Numba alone
+    # takes a noticeable fraction of a second
+    backends['numba'] = None
+
+def load(name):
+    # The kernels of a backend, importing them if they haven't been
+    if backends[name] is None:
+        from . import numba_kernels
+        backends[name] = numba_kernels.kernels
+    return backends[name]
+
+def deferred(name, kernel):
+    # Stands in for a kernel of a backend that isn't loaded yet, loading it
+    # when first called
+    def call(*args, **kwargs):
+        kernels = load(name)
+        if backend == name:
+            use(name)
+        return kernels[kernel](*args, **kwargs)
+    return call
+
+def use(name):
+    # Select the backend used by the module-level kernels
+    global backend, rmsd_matrix, superposed_rmsd_matrix, slab_moments, violation_counts
+    if name not in backends:
+        raise ValueError("Unknown or unavailable kernel backend: {}".format(name))
+    backend = name
+    kernels = backends[name] or {kernel: deferred(name, kernel) for kernel in backends['numpy']}
+    rmsd_matrix = kernels['rmsd_matrix']
+    superposed_rmsd_matrix = kernels['superposed_rmsd_matrix']
+    slab_moments = kernels['slab_moments']
+    violation_counts = kernels['violation_counts']
+
+use(os.environ.get("NUC_ANALYZE_BACKEND", "numba" if 'numba' in backends else "numpy"))
@@ -1,9 +1,69 @@
 #!/usr/bin/env python3
+from pathlib import Path
+from functools import partial
+from importlib import import_module
 import click
 
-@click.group()
-def cli():
-    pass
+from .cache import Cache
+from . import timings
+
+class LazyGroup(click.Group):
+    # Commands are registered as the module and attribute they are defined in, and
+    # only imported (along with their dependencies) when they are run
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands:
+            module, attr = self.lazy_commands[name]
+            return getattr(import_module(module, __package__ or "nuc_analyze"), attr)
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx, formatter):
+        # Avoid importing every command just to list them
+        commands = [(name, self.commands[name].get_short_help_str() if name in self.commands else "")
+                    for name in self.list_commands(ctx)]
+        if commands:
+            with formatter.section("Commands"):
+                formatter.write_dl(commands)
+
+@click.group(cls=LazyGroup, lazy_commands={
+    "align": (".align", "align"),
+    "plot-clusters": (".cluster", "plot_clusters"),
+    "rmsd": (".rmsd", "output_rmsd"),
+    "plot-rmsd": (".rmsd", "plot_rmsd"),
+    "stats": (".stats", "stats"),
+    "plot-stats": (".stats", "plot_stats"),
+    "restraint-violations": (".stats", "restraint_violations"),
+    "cross-rmsd": (".compare", "output_cross_rmsd"),
+    "export": (".export", "export"),
+    "repack": (".repack", "repack"),
+})
+@click.option("--cache-dir", type=Path, envvar="NUC_ANALYZE_CACHE",
+              help="Cache computed results in this directory")
+@click.option("--cache-size", type=float, default=1024.0,
+              help="Maximum size of the cache (in MiB)")
+@click.option("--profile", "--timings", "timings_file", type=click.File("w"),
+              help="Write the time, bytes read and peak memory of each stage to this file (as JSON)")
+@click.pass_context
+def cli(ctx, cache_dir, cache_size, timings_file):
+    ctx.obj = {}
+    if cache_dir is not None:
+        ctx.obj['cache'] = Cache(cache_dir, cache_size * 2 ** 20)
+    if timings_file is not None:
+        timings.enable()
+        ctx.call_on_close(partial(timings.disable, timings_file))
+
+@cli.command()
+@click.pass_obj
+def clear_cache(obj):
+    if obj.get('cache') is None:
+        raise click.UsageError("No cache directory given (use --cache-dir)")
+    obj['cache'].clear()
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,309 @@
+import os
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from h5py import File as HDFFile
+import numpy as np
+import click
+
+from .util import flatten_dict
+from .timings import stage
+
+def structure_names(nuc, spec):
+    # Expand a structure specification: a name, a comma-separated list of names,
+    # or 'all' (which requires nuc to be open or a path)
+    if spec != "all":
+        return spec.split(",")
+    if isinstance(nuc, (str, Path)):
+        with HDFFile(str(nuc), "r") as f:
+            return list(f['structures'].keys())
+    return list(nuc['structures'].keys())
+
+def multiple_structures(spec):
+    return spec == "all" or "," in spec
+
+def structure_tasks(nucs, spec, jobs=1):
+    # (nuc, structures) pairs to process, one per file so that each file is only
+    # opened once, or one per structure if they are spread over several jobs
+    for nuc in nucs:
+        names = tuple(structure_names(nuc, spec))
+        if jobs > 1:
+            yield from ((nuc, (name,)) for name in names)
+        else:
+            yield nuc, names
+
+def slab_size(dataset, axis=0, budget=None):
+    # How many indices along axis fit in budget bytes (as doubles), rounded down
+    # to a whole number of chunks if possible. Without a budget, one chunk.
+    chunks = getattr(dataset, 'chunks', None)
+    chunk = chunks[axis] if chunks is not None else dataset.shape[axis]
+    if budget is None:
+        return chunk
+    row = np.prod(dataset.shape, dtype='int') // max(dataset.shape[axis], 1)
+    size = max(int(budget // (row * np.dtype('double').itemsize)), 1)
+    if size > chunk:
+        size -= size % chunk
+    return size
+
+def slabs(dataset, axis=0, size=None):
+    # Slices along axis of at most size indices (or all at once if None)
+    length = dataset.shape[axis]
+    size = length if size is None else max(size, 1)
+    for start in range(0, length, size):
+        yield slice(start, min(start + size, length))
+
+def precision_option(f):
+    # The dtype of NucFile coordinates, and so of calculations on them
+    return click.option("--precision", type=click.Choice(["float64", "float32"]),
+                        default="float64", help="Floating-point precision to calculate in")(f)
+
+def read(array, selection=(), dtype='double'):
+    # array[selection] as dtype. HDF5 datasets are converted as they are read,
+    # rather than read in their stored type and then copied.
+    if hasattr(array, 'id') and hasattr(array, 'astype'):
+        return array.astype(dtype)[selection]
+    return np.asarray(array[selection], dtype=dtype)
+
+def sidecar_paths(nuc, structure="0"):
+    # Files a structure of the .nuc file at path nuc is exported to
+    nuc = Path(str(nuc))
+    base = "{}.{}".format(nuc.name, structure)
+    return {'coords': nuc.with_name(base + ".coords.npy"),
+            'positions': nuc.with_name(base + ".positions.npy"),
+            'meta': nuc.with_name(base + ".json")}
+
+def source_stat(nuc):
+    st = os.stat(str(nuc))
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def export_sidecar(nuc, structure="0"):
+    # Write a structure's coordinates, concatenated over chromosomes, to a .npy
+    # file that can be memory-mapped, with its particle positions (if it has
+    # them) and metadata. The metadata is written last, so a partial export is
+    # never used.
+    paths = sidecar_paths(nuc, structure)
+    source = source_stat(nuc)
+    if paths['meta'].exists():
+        paths['meta'].unlink()
+    with NucFile.open(nuc, structure, sidecar=False) as nucfile:
+        has_positions = all("particles/{}/positions".format(chromo) in nucfile.group
+                            for chromo in nucfile.chromosomes)
+        datasets = nucfile.datasets
+        offsets = nucfile.offsets
+        dtype = np.result_type(*(d.dtype for d in datasets.values()))
+        shape = (nucfile.nmodels, sum(d.shape[1] for d in datasets.values()), 3)
+        coords = np.lib.format.open_memmap(str(paths['coords']), mode='w+', dtype=dtype,
+                                           shape=shape)
+        for chromo, dataset in datasets.items():
+            for s in slabs(dataset, axis=0, size=slab_size(dataset, axis=0)):
+                with stage("read"):
+                    coords[s, offsets[chromo]] = dataset[s]
+        coords.flush()
+        del coords
+        if has_positions:
+            positions = [nucfile.positions(chromo) for chromo in nucfile.chromosomes]
+            np.save(str(paths['positions']), np.concatenate(positions or [np.empty(0, 'int')]))
+        elif paths['positions'].exists():
+            paths['positions'].unlink()
+        meta = {'source': source, 'structure': structure, 'positions': has_positions,
+                'chromosomes': [[chromo, offsets[chromo].start, offsets[chromo].stop]
+                                for chromo in nucfile.chromosomes]}
+    with paths['meta'].open("w") as f:
+        json.dump(meta, f)
+    return paths
+
+def load_sidecar(nuc, structure="0"):
+    # Memory-mapped coordinates and positions (None if it has none) exported
+    # from the .nuc file at path nuc, by chromosome, or None if there are none
+    # or the file has changed since
+    paths = sidecar_paths(nuc, structure)
+    try:
+        with paths['meta'].open() as f:
+            meta = json.load(f)
+        if meta['source'] != source_stat(nuc):
+            return None
+        # Plain views of the maps, so results don't keep the memmap subclass
+        coords = np.asarray(np.load(str(paths['coords']), mmap_mode='r'))
+        positions = None
+        if meta.get('positions', True):
+            positions = np.asarray(np.load(str(paths['positions']), mmap_mode='r'))
+    except (OSError, ValueError, KeyError):
+        return None
+    offsets = {chromo: slice(start, stop) for chromo, start, stop in meta['chromosomes']}
+    return {'coords': coords, 'positions': positions, 'offsets': offsets}
+
+class NucFile:
+    # Read access to one structure of an open .nuc file (or a nested dict of the
+    # same layout), optionally restricted to some chromosomes or models. Each
+    # dataset is read at most once, however many times it is used. Coordinates
+    # and positions are read from an up-to-date exported sidecar if there is one.
+    # Coordinates are converted to dtype, the precision calculations run in.
+    def __init__(self, nuc, structure="0", chromosomes=None, models=None, sidecar=True,
+                 dtype='double'):
+        self.nuc = nuc
+        self.structure = structure
+        self.group = nuc['structures'][structure]
+        self.chromosomes = list(self.group['coords'].keys())
+        if chromosomes is not None:
+            self.chromosomes = [c for c in self.chromosomes if c in set(chromosomes)]
+        self.models = models
+        self.dtype = np.dtype(dtype)
+        self.sidecar = None
+        filename = getattr(nuc, 'filename', None)
+        if sidecar is True and filename is not None:
+            self.sidecar = load_sidecar(filename, structure)
+        elif sidecar not in (True, False):
+            self.sidecar = sidecar
+        self._coords = {}
+        self._positions = {}
+        self._all_coords = None
+        self._restraints = None
+        self._restraint_index = None
+
+    @classmethod
+    @contextmanager
+    def open(cls, path, structure="0", mode="r", **kwargs):
+        with HDFFile(str(path), mode) as f:
+            yield cls(f, structure, **kwargs)
+
+    def select(self, chromosomes=None, models=None):
+        # A new accessor for a subset of this one's chromosomes, or other models
+        if chromosomes is None:
+            chromosomes = self.chromosomes
+        else:
+            chromosomes = [c for c in self.chromosomes if c in set(chromosomes)]
+        return type(self)(self.nuc, self.structure, chromosomes, models,
+                          sidecar=self.sidecar or False, dtype=self.dtype)
+
+    @property
+    def datasets(self):
+        return {chromo: self.group['coords'][chromo] for chromo in self.chromosomes}
+
+    @property
+    def arrays(self):
+        # Coordinates of each chromosome to read from, which may be memory-mapped
+        return {chromo: self.array(chromo) for chromo in self.chromosomes}
+
+    def array(self, chromo):
+        if self.sidecar is not None:
+            return self.sidecar['coords'][:, self.sidecar['offsets'][chromo]]
+        return self.group['coords'][chromo]
+
+    @property
+    def nmodels(self):
+        nmodels = self.group['coords'][self.chromosomes[0]].shape[0]
+        if self.models is None:
+            return nmodels
+        return len(np.arange(nmodels)[self.models])
+
+    @property
+    def offsets(self):
+        # Slices of each chromosome's particles in all_coords
+        offsets = {}
+        start = 0
+        for chromo in self.chromosomes:
+            stop = start + self.group['coords'][chromo].shape[1]
+            offsets[chromo] = slice(start, stop)
+            start = stop
+        return offsets
+
+    def coords(self, chromo):
+        if chromo not in self._coords:
+            dataset = self.array(chromo)
+            with stage("read"):
+                selection = slice(None) if self.models is None else self.models
+                self._coords[chromo] = read(dataset, selection, self.dtype)
+        return self._coords[chromo]
+
+    def positions(self, chromo):
+        if chromo not in self._positions:
+            with stage("read"):
+                if self.sidecar is not None and self.sidecar['positions'] is not None:
+                    positions = self.sidecar['positions'][self.sidecar['offsets'][chromo]]
+                else:
+                    positions = self.group['particles'][chromo]['positions']
+                self._positions[chromo] = positions[:]
+        return self._positions[chromo]
+
+    @property
+    def all_coords(self):
+        if self._all_coords is None and self.sidecar is not None and self.models is None:
+            # The sidecar is already concatenated, so a selection of consecutive
+            # chromosomes is a view of it
+            offsets = [self.sidecar['offsets'][chromo] for chromo in self.chromosomes]
+            if offsets and all(a.stop == b.start for a, b in zip(offsets, offsets[1:])):
+                self._all_coords = read(self.sidecar['coords'],
+                                        np.s_[:, offsets[0].start:offsets[-1].stop], self.dtype)
+        if self._all_coords is None:
+            coords = list(map(self.coords, self.chromosomes))
+            with stage("concatenate"):
+                self._all_coords = np.concatenate(coords, axis=1)
+        return self._all_coords
+
+    @property
+    def restraints(self):
+        # Non-empty restraints between selected chromosomes, by chromosome pair
+        if self._restraints is None:
+            chromosomes = set(self.chromosomes)
+            with stage("read"):
+                self._restraints = {
+                    (chr_a, chr_b): v[:] for (chr_a, chr_b), v
+                    in flatten_dict(self.group['restraints']).items()
+                    if len(v) > 0 and chr_a in chromosomes and chr_b in chromosomes
+                }
+        return self._restraints
+
+    @property
+    def restraint_index(self):
+        # All restraints as flat arrays of their chromosome pairs, particle
+        # indices within each chromosome, and bounds
+        if self._restraint_index is None:
+            restraints = self.restraints
+            chromosomes = [np.repeat([pair], len(r), axis=0) for pair, r in restraints.items()]
+            indices = [r['indices'] for r in restraints.values()]
+            dists = [r['dists'] for r in restraints.values()]
+            self._restraint_index = {
+                'chromosomes': np.concatenate(chromosomes or [np.empty((0, 2), dtype='str')]),
+                'indices': np.concatenate(indices or [np.empty((0, 2), dtype='int')]),
+                'dists': np.concatenate(dists or [np.empty((0, 2), dtype='float')]),
+            }
+        return self._restraint_index
+
+    def fingerprint(self):
+        # Cheap hash of the selected coordinates, to detect when they have
+        # changed: their shapes and the first and last selected models, as
+        # models are only appended or all rewritten (see incremental.models_hash)
+        from hashlib import sha1
+
+        h = sha1()
+        for chromo in self.chromosomes:
+            h.update(repr((chromo, self.group['coords'][chromo].shape, self.nmodels)).encode())
+            if not self.nmodels:
+                continue
+            models = np.arange(self.group['coords'][chromo].shape[0])
+            if self.models is not None:
+                models = models[self.models]
+            with stage("read"):
+                # Independent of the precision calculations run in
+                sample = read(self.array(chromo), sorted({models[0], models[-1]}), 'double')
+            h.update(np.ascontiguousarray(sample).tobytes())
+        return h.hexdigest()
+
+    def model_slabs(self, chromo, size=None, dtype=None):
+        # Read the selected models of a chromosome one slab at a time, one chunk
+        # deep by default. Model selections must be in increasing order.
+        dtype = self.dtype if dtype is None else dtype
+        dataset = self.group['coords'][chromo]
+        if size is None:
+            size = slab_size(dataset, axis=0)
+        dataset = self.array(chromo)
+        if self.models is None:
+            selections = slabs(dataset, axis=0, size=size)
+        else:
+            models = np.arange(dataset.shape[0])[self.models]
+            selections = (models[s] for s in slabs(models, axis=0, size=size))
+        for s in selections:
+            # Only the reading itself, not what the caller does with each slab
+            with stage("read"):
+                slab = read(dataset, s, dtype)
+            yield slab
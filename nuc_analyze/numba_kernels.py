@@ -0,0 +1,50 @@
+import numba
+import numpy as np
+
+from .kernels import numpy_rmsd_matrix, numpy_superposed_rmsd_matrix
+
+# The Numba backend of kernels.py, only imported when first used
+
+@numba.njit(parallel=True, cache=True)
+def numba_slab_moments(slab):
+    models, particles, ndim = slab.shape
+    mean = np.empty((particles, ndim))
+    m2 = np.zeros(particles)
+    for p in numba.prange(particles):
+        for k in range(ndim):
+            total = 0.0
+            for m in range(models):
+                total += slab[m, p, k]
+            mu = total / models
+            mean[p, k] = mu
+            total = 0.0
+            for m in range(models):
+                d = slab[m, p, k] - mu
+                total += d * d
+            m2[p] += total
+    return mean, m2
+
+@numba.njit(parallel=True, cache=True)
+def numba_violation_counts(a_coords, b_coords, indices, lower, upper, padding):
+    counts = np.zeros(a_coords.shape[0], dtype=np.int64)
+    for m in numba.prange(a_coords.shape[0]):
+        count = 0
+        for r in range(indices.shape[0]):
+            total = 0.0
+            for k in range(a_coords.shape[2]):
+                d = a_coords[m, indices[r, 0], k] - b_coords[m, indices[r, 1], k]
+                total += d * d
+            dist = np.sqrt(total)
+            if upper[r] * (1.0 + padding) < dist or lower[r] * (1.0 - padding) > dist:
+                count += 1
+        counts[m] = count
+    return counts
+
+kernels = {
+    # A fused loop can't compete with the BLAS matrix product of the Gram
+    # formulation, so that is kept for RMSDs between models
+    'rmsd_matrix': numpy_rmsd_matrix,
+    'superposed_rmsd_matrix': numpy_superposed_rmsd_matrix,
+    'slab_moments': numba_slab_moments,
+    'violation_counts': numba_violation_counts,
+}
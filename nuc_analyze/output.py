@@ -0,0 +1,79 @@
+from pathlib import Path
+from collections import OrderedDict
+import numpy as np
+import click
+
+from .timings import stage
+
+# Tables of results are written as whole columns, rather than one row at a time
+
+def write_csv(columns, output=None):
+    # Values are written as they are, so e.g. calculation parameters of mixed
+    # types or shapes print as they are stored
+    import csv
+    import sys
+
+    f = sys.stdout if output is None else open(str(output), "w", newline="")
+    try:
+        writer = csv.writer(f)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*(c.tolist() if isinstance(c, np.ndarray) else c
+                               for c in columns.values())))
+    finally:
+        if output is not None:
+            f.close()
+
+def write_npz(columns, output):
+    np.savez(str(output), **columns)
+
+def write_hdf5(columns, output):
+    from h5py import File as HDFFile
+
+    with HDFFile(str(output), "w") as f:
+        for name, column in columns.items():
+            if column.dtype.kind == 'U':
+                column = np.char.encode(column, 'utf-8')
+            f.create_dataset(name, data=column)
+
+def write_parquet(columns, output):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise click.ClickException("Parquet output requires pyarrow to be installed")
+    table = pyarrow.table({name: pyarrow.array(column) for name, column in columns.items()})
+    pyarrow.parquet.write_table(table, str(output))
+
+writers = OrderedDict([
+    ('csv', write_csv), ('hdf5', write_hdf5), ('npz', write_npz), ('parquet', write_parquet),
+])
+
+def output_options(default='csv', formats=tuple(writers)):
+    def decorate(f):
+        f = click.option("--output", type=Path,
+                         help="Where to write results (stdout if not given, for text formats)")(f)
+        f = click.option("--output-format", type=click.Choice(list(formats)), default=default,
+                         help="How to write results")(f)
+        return f
+    return decorate
+
+def as_array(name, column, fmt):
+    try:
+        array = np.asarray(column)
+    except ValueError:
+        array = None
+    if array is None or array.dtype == object:
+        raise click.ClickException(
+            "Column {} can't be written as {}: its values differ in type or shape".format(name, fmt)
+        )
+    return array
+
+def write_table(columns, fmt='csv', output=None):
+    # Write a table given as named columns of equal length
+    if fmt != 'csv':
+        if output is None:
+            raise click.UsageError("--output is required for {} output".format(fmt))
+        columns = OrderedDict((name, as_array(name, column, fmt))
+                              for name, column in columns.items())
+    with stage("output"):
+        writers[fmt](columns, output)
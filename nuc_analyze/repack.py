@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from h5py import File as HDFFile
+import numpy as np
+import click
+
+from .main import cli
+from .timings import stage, file as timed_file
+from .nucfile import slabs, slab_size
+
+def chunk_shape(shape, dtype, target=2 ** 20):
+    # Chunks of about target bytes, about as deep in models as in particles, so
+    # that reading whole models or whole particles doesn't read much else
+    models, particles, ndim = shape
+    row = np.dtype(dtype).itemsize * ndim
+    size = max(int(np.sqrt(target / row)), 1)
+    model_chunk = max(min(models, size), 1)
+    particle_chunk = max(min(particles, int(target // (row * model_chunk))), 1)
+    return model_chunk, particle_chunk, ndim
+
+def read_times(nuc):
+    # Seconds to read every structure's coordinates by whole models, and by
+    # whole particles, one chunk deep at a time
+    from time import perf_counter
+
+    times = {'model': 0.0, 'particle': 0.0}
+    with HDFFile(str(nuc), "r") as f:
+        for structure in f['structures'].values():
+            for dataset in structure['coords'].values():
+                for axis, name in [(0, 'model'), (1, 'particle')]:
+                    start = perf_counter()
+                    for s in slabs(dataset, axis, slab_size(dataset, axis)):
+                        dataset[(slice(None),) * axis + (s,)]
+                    times[name] += perf_counter() - start
+    return times
+
+def copy_group(src, dst, skip=()):
+    dst.attrs.update(src.attrs)
+    for name, obj in src.items():
+        if name not in skip:
+            src.copy(obj, dst, name=name)
+
+def repack_file(src, dst, compression=None, chunk_size=2 ** 20):
+    # Copy the .nuc file src to dst, rewriting coordinates in chunks of about
+    # chunk_size bytes
+    options = {} if compression is None else {'compression': compression, 'shuffle': True}
+    with HDFFile(str(src), "r") as f, HDFFile(str(dst), "w") as g:
+        copy_group(f, g, skip=("structures",))
+        structures = g.create_group("structures")
+        structures.attrs.update(f['structures'].attrs)
+        for structure_name, structure in f['structures'].items():
+            out = structures.create_group(structure_name)
+            copy_group(structure, out, skip=("coords",))
+            coords = out.create_group("coords")
+            coords.attrs.update(structure['coords'].attrs)
+            for chromo, dataset in structure['coords'].items():
+                chunks = chunk_shape(dataset.shape, dataset.dtype, chunk_size)
+                # Keep everything but the layout, so e.g. models can still be appended
+                properties = {'maxshape': dataset.maxshape, 'fillvalue': dataset.fillvalue,
+                              'fletcher32': dataset.fletcher32}
+                if dataset.scaleoffset is not None:
+                    properties['scaleoffset'] = dataset.scaleoffset
+                repacked = coords.create_dataset(chromo, shape=dataset.shape, dtype=dataset.dtype,
+                                                 chunks=chunks, **properties, **options)
+                repacked.attrs.update(dataset.attrs)
+                for s in slabs(dataset, 0, max(slab_size(dataset, 0), chunks[0])):
+                    with stage("read"):
+                        data = dataset[s]
+                    with stage("write"):
+                        repacked[s] = data
+
+@cli.command()
+@click.argument("nuc", type=Path, required=True)
+@click.option("--output", type=Path, help="Where to write the repacked file (default: in place)")
+@click.option("--compression", type=click.Choice(["none", "gzip", "lzf"]), default="gzip",
+              help="How to compress the coordinates (lzf is faster, but only readable with h5py)")
+@click.option("--chunk-size", type=float, default=1.0, help="The size of chunks (in MiB)")
+def repack(nuc, output, compression, chunk_size):
+    import os
+
+    dst = nuc.with_name(nuc.name + ".repack") if output is None else output
+    with timed_file(nuc):
+        before = read_times(nuc)
+        repack_file(nuc, dst, None if compression == "none" else compression,
+                    chunk_size * 2 ** 20)
+        after = read_times(dst)
+    if output is None:
+        os.replace(str(dst), str(nuc))
+    for name in ['model', 'particle']:
+        click.echo("{} reads: {:.3f}s -> {:.3f}s ({:.2f}x)".format(
+            name, before[name], after[name], before[name] / max(after[name], 1e-9)
+        ))
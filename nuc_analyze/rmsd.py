@@ -1,68 +1,224 @@
 #!/usr/bin/env python3
 from pathlib import Path
-from h5py import File as HDFFile
 import numpy as np
-import operator as op
 import click
-from coherent_point_drift.least_squares import align
 from functools import partial
 from itertools import repeat, chain
 
 from .main import cli
+from .cache import cached, current_cache
+from .timings import stage, file as timed_file
+from .nucfile import NucFile, precision_option
+from .output import output_options, write_table
+from .util import ceil_div
+from . import kernels, incremental
 
-def rmsd(nuc, structure="0"):
-    for chromo, coords in nuc['structures'][structure]['coords'].items():
-        mean = np.mean(coords, axis=0, keepdims=True)
-        error = np.linalg.norm((coords - mean), axis=-1)
-        rmsds = np.sqrt(np.mean(error ** 2, axis=0))
-        positions = nuc['structures'][structure]['particles'][chromo]['positions'][:]
-        yield chromo, positions, rmsds
+def merge_moments(a, b):
+    # Combine (count, mean, m2) moments of two disjoint sets of models
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    total = n_a + n_b
+    if not total:
+        return a
+    delta = mean_b - mean_a
+    m2 = m2_a + m2_b + np.sum(delta ** 2, axis=-1) * (n_a * n_b / total)
+    return total, mean_a + delta * (n_b / total), m2
+
+def moments(slabs, initial=(0, 0.0, 0.0)):
+    # Per-particle count, mean and sum of squared deviations (summed over each
+    # dimension) of (models, particles, 3) slabs of the same particles, merged
+    # into initial moments if given
+    result = initial
+    for slab in slabs:
+        result = merge_moments(result, (len(slab),) + tuple(kernels.slab_moments(slab)))
+    return result
+
+def rmsd(nuc, structure="0", slab_size=None, store=False, precision='float64'):
+    # If store is set, moments are kept in the file's analysis group, and only
+    # models added since they were stored are read. Moments are accumulated
+    # per slab and merged, so results can differ from a single pass over all
+    # models in the last few bits (relative differences of about 1e-15).
+    nucfile = NucFile(nuc, structure, dtype=precision)
+    for chromo in nucfile.chromosomes:
+        with stage("rmsd"):
+            if store:
+                n, _, m2 = stored_moments(nuc, nucfile.select(chromosomes=[chromo]), slab_size)
+            else:
+                n, _, m2 = moments(nucfile.model_slabs(chromo, slab_size))
+            rmsds = np.sqrt(m2 / n)
+        yield chromo, nucfile.positions(chromo), rmsds
+
+def stored_moments(f, nucfile, slab_size=None):
+    # Moments of nucfile's single chromosome, updated with any new models
+    chromo, = nucfile.chromosomes
+    path = "analysis/rmsd/{}/{}".format(nucfile.structure, chromo)
+    group, stored = incremental.load(f, path, nucfile)
+    if stored == nucfile.nmodels:
+        with stage("read"):
+            return stored, group['mean'][:], group['m2'][:]
+    initial = (0, 0.0, 0.0) if group is None else (stored, group['mean'][:], group['m2'][:])
+    new = nucfile.select(models=slice(stored, None))
+    n, mean, m2 = moments(new.model_slabs(chromo, slab_size), initial)
+    incremental.save(f, path, nucfile, mean=mean, m2=m2)
+    return n, mean, m2
+
+def downsample(x, y, max_points):
+    # Min/max binning: the lowest and highest point of each bin of consecutive
+    # points, so peaks survive with at most max_points points left
+    n = len(y)
+    if not max_points or n <= max_points:
+        return x, y
+    if max_points == 1:
+        # Bins give a pair of points each, so just the highest
+        idx = np.argmax(y)
+        return x[idx:idx + 1], y[idx:idx + 1]
+    size = ceil_div(n, max_points // 2)
+    bins = ceil_div(n, size)
+    # Pad the last bin by repeating the last point, which can't change its extremes
+    binned = np.pad(y, (0, bins * size - n), mode='edge').reshape(bins, size)
+    offsets = np.arange(bins) * size
+    idx = np.concatenate([offsets + np.argmin(binned, axis=1), offsets + np.argmax(binned, axis=1)])
+    idx = np.unique(np.minimum(idx, n - 1))
+    return x[idx], y[idx]
+
+def join_rmsds(nucs_rmsds):
+    # Join per-file results of rmsd on the positions present in every file,
+    # returning sorted positions and the maximum RMSD over files per chromosome
+    joined = None
+    for nuc_rmsds in nucs_rmsds:
+        nuc_rmsds = {chromo: (positions, rmsds) for chromo, positions, rmsds in nuc_rmsds}
+        if joined is None:
+            joined = {}
+            for chromo, (positions, rmsds) in nuc_rmsds.items():
+                positions, idx = np.unique(positions, return_index=True)
+                joined[chromo] = positions, rmsds[idx]
+            continue
+        for chromo in list(joined):
+            if chromo not in nuc_rmsds:
+                del joined[chromo]
+                continue
+            positions, rmsds = joined[chromo]
+            other_positions, other_rmsds = nuc_rmsds[chromo]
+            positions, idx, other_idx = np.intersect1d(
+                positions, other_positions, return_indices=True
+            )
+            joined[chromo] = positions, np.maximum(rmsds[idx], other_rmsds[other_idx])
+    return joined or {}
+
+def file_rmsd(nuc, structures=("0",), store=False, precision='float64'):
+    # Per-particle RMSDs of each structure in a .nuc file at path nuc
+    def structure_rmsds(f):
+        return [(structure, list(rmsd(f, structure, store=store, precision=precision)))
+                for structure in structures]
+    with timed_file(nuc):
+        return incremental.with_file(nuc, structure_rmsds, store)
 
 @cli.command("rmsd")
 @click.argument("nucs", type=Path, nargs=-1, required=True)
-@click.option("--structure", default="0", help="Which structure in the file to read")
+@click.option("--structure", default="0",
+              help="Which structure in the file to read ('all', or a comma-separated list)")
 @click.option("--position", multiple=True, type=(str, int),
               help="Which positions to look at (or all if none provided)")
-def output_rmsd(nucs, structure, position):
-    from functools import partial
-
-    nucs_rmsds = []
-    for nuc in nucs:
-        with HDFFile(nuc, "r") as f:
-            nuc_rmsds = {}
-            for chromo, positions, rmsds in rmsd(f, structure):
-                nuc_rmsds.update(zip(zip(repeat(chromo), positions), rmsds))
-            nucs_rmsds.append(nuc_rmsds)
-    conserved = set.intersection(*map(set, nucs_rmsds))
-    if position:
-        positions = filter(partial(op.contains, conserved), position)
-    else:
-        positions = sorted(conserved)
-    for chromo, pos in positions:
-        print("{}:{} {}".format(chromo, pos, max(rmsd[chromo, pos] for rmsd in nucs_rmsds)))
+@click.option("--jobs", type=int, default=1, help="How many files to process in parallel")
+@click.option("--store/--no-store", default=False,
+              help="Keep partial results in the file, so later runs only read new models")
+@precision_option
+@output_options(default='text', formats=['text', 'csv', 'hdf5', 'npz', 'parquet'])
+def output_rmsd(nucs, structure, position, jobs, store, precision, output_format, output):
+    from sys import stdout
+    from collections import OrderedDict
+    from .util import parallel_starmap
+    from .nucfile import structure_tasks, multiple_structures
+
+    # Results of each structure, over all the files it is in
+    structures_rmsds = OrderedDict()
+    # Structures of a file can't be written to from several processes at once
+    tasks = structure_tasks(nucs, structure, 1 if store else jobs)
+    for nuc_rmsds in parallel_starmap(partial(cached, current_cache(), file_rmsd, store=store,
+                                              precision=precision), tasks, jobs):
+        for structure_name, rmsds in nuc_rmsds:
+            structures_rmsds.setdefault(structure_name, []).append(rmsds)
+
+    # (structure, chromosome, positions, rmsds) of each chromosome to output
+    results = []
+    for structure_name, nucs_rmsds in structures_rmsds.items():
+        with stage("join"):
+            conserved = join_rmsds(nucs_rmsds)
+        if position:
+            for chromo, pos in position:
+                if chromo not in conserved:
+                    continue
+                positions, rmsds = conserved[chromo]
+                idx = np.searchsorted(positions, pos)
+                if idx < len(positions) and positions[idx] == pos:
+                    results.append((structure_name, chromo,
+                                    positions[idx:idx + 1], rmsds[idx:idx + 1]))
+        else:
+            results.extend((structure_name, chromo, positions, rmsds)
+                           for chromo, (positions, rmsds) in sorted(conserved.items()))
+
+    if output_format != 'text':
+        columns = OrderedDict()
+        if multiple_structures(structure):
+            columns["structure"] = np.repeat([s for s, _, p, _ in results],
+                                             [len(p) for _, _, p, _ in results])
+        columns["chromosome"] = np.repeat([c for _, c, p, _ in results],
+                                          [len(p) for _, _, p, _ in results])
+        columns["position"] = np.concatenate([p for _, _, p, _ in results] or [np.empty(0, 'int')])
+        columns["rmsd"] = np.concatenate([r for _, _, _, r in results] or [np.empty(0)])
+        write_table(columns, output_format, output)
+        return
+
+    lines = []
+    for structure_name, chromo, positions, rmsds in results:
+        fmt = "{}:{} {}"
+        if multiple_structures(structure):
+            fmt = structure_name.replace("{", "{{").replace("}", "}}") + " " + fmt
+        lines.extend(map(fmt.format, repeat(chromo), positions.tolist(), rmsds.tolist()))
+    if lines:
+        with stage("output"):
+            if output is None:
+                stdout.write('\n'.join(lines) + '\n')
+            else:
+                output.write_text('\n'.join(lines) + '\n')
 
 @cli.command()
 @click.argument("nucs", type=Path, nargs=-1, required=True)
 @click.option("--structure", default="0", help="Which structure in the file to read")
 @click.option("--cols", type=int, default=1)
-def plot_rmsd(nucs, structure, cols):
+@click.option("--jobs", type=int, default=1, help="How many files to process in parallel")
+@click.option("--output", help="Where to save the plot")
+@click.option("--max-points", type=click.IntRange(min=0), default=4000,
+              help="Downsample each line to at most this many points, keeping peaks (0 for all)")
+@precision_option
+def plot_rmsd(nucs, structure, cols, jobs, output, max_points, precision):
+    import matplotlib
+    if output is not None:
+        matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    from .util import ceil_div
+    from .util import parallel_map
     from collections import defaultdict
 
     rmsdss = defaultdict(list)
-    for nuc in nucs:
-        with HDFFile(nuc, "r") as f:
-            for chromosome, pos, rmsds in rmsd(f, structure):
-                rmsdss[chromosome].append((pos, rmsds))
-    fig, axs = plt.subplots(ceil_div(len(rmsdss), cols), cols, sharex=True, sharey=True)
-    if cols == 1:
-        # Fix matplotlib's return type
-        axs = [axs]
-    for ax, (chromosome, data) in zip(chain.from_iterable(axs), sorted(rmsdss.items())):
-        for poss, rmsds in data:
-            ax.plot(poss, rmsds)
-        ax.set_ylabel('\n'.join(("RMSD", chromosome)))
+    for ((_, nuc_rmsd),) in parallel_map(
+            partial(cached, current_cache(), file_rmsd, structures=(structure,),
+                    precision=precision), nucs, jobs
+    ):
+        for chromosome, pos, rmsds in nuc_rmsd:
+            rmsdss[chromosome].append((pos, rmsds))
+    fig, axs = plt.subplots(ceil_div(len(rmsdss), cols), cols, sharex=True, sharey=True,
+                            squeeze=False)
+    with stage("plot"):
+        for ax, (chromosome, data) in zip(chain.from_iterable(axs), sorted(rmsdss.items())):
+            for poss, rmsds in data:
+                ax.plot(*downsample(poss, rmsds, max_points))
+            ax.set_ylabel('\n'.join(("RMSD", chromosome)))
     for ax in axs[-1]:
         ax.set_xlabel("Genome Position (bp)")
-    plt.show()
+
+    if output is None:
+        plt.show()
+    else:
+        with stage("save"):
+            fig.tight_layout()
+            fig.savefig(str(output))
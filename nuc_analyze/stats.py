@@ -1,92 +1,230 @@
 from pathlib import Path
-from h5py import File as HDFFile
 import numpy as np
-from collections import Counter, defaultdict
-from itertools import chain, product as cartesian
+from itertools import chain
+from collections import OrderedDict
+from functools import partial
 import click
 
 from .main import cli
-from .util import flatten_dict
+from .util import flatten_dict, parallel_map, parallel_starmap
+from .nucfile import NucFile, multiple_structures, structure_tasks, precision_option
+from .cache import cached, current_cache
+from .timings import stage, file as timed_file
+from .output import output_options, write_table
+from . import kernels, incremental
+
+statistics = {}
+statistic_options = {}
+
+def statistic(name, **options):
+    # Register a function computing per-model values from a NucFile. Options map
+    # its keyword arguments to the command-line options they are read from.
+    def register(f):
+        statistics[name] = f
+        statistic_options[name] = options
+        return f
+    return register
+
+@statistic("scale")
+def structure_scale(nucfile):
+    return np.mean(np.std(nucfile.all_coords, axis=1), axis=1)
+
+@statistic("violations", padding="violation_padding")
+def structure_violations(nucfile, padding=0.0):
+    violations = np.zeros(nucfile.nmodels, dtype='int')
+
+    for (chr_a, chr_b), restraints in nucfile.restraints.items():
+        violations += kernels.violation_counts(
+            nucfile.coords(chr_a), nucfile.coords(chr_b),
+            np.ascontiguousarray(restraints['indices']),
+            np.ascontiguousarray(restraints['dists'][:, 0]),
+            np.ascontiguousarray(restraints['dists'][:, 1]), padding
+        )
+    return violations
+
+def relative_violations(nucfile):
+    # How much (relative to the bound) each restraint is violated by in each
+    # model, so a restraint is violated with padding p where this exceeds p.
+    # Takes (models x restraints) memory, see violation_blocks to avoid that.
+    blocks = list(violation_blocks(nucfile))
+    return np.concatenate(blocks or [np.empty((nucfile.nmodels, 0))], axis=1)
+
+def violation_blocks(nucfile, block_size=4096):
+    # relative_violations of at most block_size restraints at a time, in the
+    # order of nucfile.restraint_index
+    for (chr_a, chr_b), restraints in nucfile.restraints.items():
+        a_coords, b_coords = nucfile.coords(chr_a), nucfile.coords(chr_b)
+        for start in range(0, len(restraints), block_size):
+            block = restraints[start:start + block_size]
+            yield block_violations(a_coords, b_coords, block['indices'], block['dists'])
+
+def block_violations(a_coords, b_coords, indices, dists):
+    dist = np.linalg.norm(a_coords[:, indices[:, 0]] - b_coords[:, indices[:, 1]], axis=-1)
+    lower, upper = dists.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # A zero upper bound is violated by any separation, a zero lower bound never
+        over = np.where(upper > 0, (dist - upper) / upper, np.where(dist > 0, np.inf, -np.inf))
+        under = np.where(lower > 0, (lower - dist) / lower, -np.inf)
+    return np.maximum(over, under)
 
 def scale(nuc, structure="0"):
-    coords = np.concatenate(list(nuc['structures'][structure]['coords'].values()), axis=1)
-    return np.mean(np.std(coords, axis=1), axis=1)
+    return structure_scale(NucFile(nuc, structure))
 
 def violations(nuc, structure="0", padding=0.0):
-    coords = nuc['structures'][structure]['coords']
-    restraints = nuc['structures'][structure]['restraints']
-    violations = Counter()
-
-    for (chr_a, chr_b), restraints in flatten_dict(restraints).items():
-        if not len(restraints) > 0:
-            continue
-        a_coords = coords[chr_a][:][:, restraints['indices'][:, 0]]
-        b_coords = coords[chr_b][:][:, restraints['indices'][:, 1]]
-        dist = np.linalg.norm(a_coords - b_coords, axis=-1)
-        viol = ((restraints['dists'][:, 1] * (1.0 + padding) < dist) |
-                (restraints['dists'][:, 0] * (1.0 - padding) > dist))
-        for model, model_violations in enumerate(viol):
-            violations[model] += model_violations.sum()
-    # Order of models doesn't matter, summarized anyway
-    return list(violations.values())
+    return structure_violations(NucFile(nuc, structure), padding=padding)
+
+def compute_stats(nuc, structure, stat_kwargs, store=False, precision='float64'):
+    # Compute each statistic in stat_kwargs from a single view of the structure.
+    # If store is set, per-model values are kept in the file's analysis group,
+    # and only computed for models added since.
+    nucfile = NucFile(nuc, structure, dtype=precision)
+    # One view of each range of new models, shared between statistics
+    new_models = {}
+    values = {}
+    for stat, kwargs in stat_kwargs.items():
+        with stage(stat):
+            if not store:
+                values[stat] = statistics[stat](nucfile, **kwargs)
+                continue
+            path = "analysis/stats/{}/{}/{}".format(structure, stat, incremental.kwargs_key(kwargs))
+            group, stored = incremental.load(nuc, path, nucfile)
+            with stage("read"):
+                old = group['values'][:] if group is not None else None
+            if stored == nucfile.nmodels:
+                values[stat] = old
+                continue
+            if stored not in new_models:
+                new_models[stored] = nucfile.select(models=slice(stored, None))
+            new = statistics[stat](new_models[stored], **kwargs)
+            values[stat] = new if old is None else np.concatenate([old, new])
+            incremental.save(nuc, path, nucfile, values=values[stat])
+    return values
+
+def file_stats(nuc, structures, params, stat_kwargs, store=False, precision='float64'):
+    # Read calculation parameters and statistics of each structure in a .nuc file
+    # at path nuc, returning (structure, params, stats) for each
+    def structure_stats(f):
+        results = []
+        for structure in structures:
+            attrs = f['structures'][structure]['calculation'].attrs
+            structure_params = {k: attrs[k] for k in params}
+            if "particle_sizes" in structure_params:
+                structure_params["particle_sizes"] = structure_params["particle_sizes"][-1]
+            results.append((structure, structure_params,
+                            compute_stats(f, structure, stat_kwargs, store, precision)))
+        return results
+    with timed_file(nuc):
+        return incremental.with_file(nuc, structure_stats, store)
+
+def stat_options(f):
+    f = precision_option(f)
+    f = click.option("--store/--no-store", default=False,
+                     help="Keep per-model values in the file, so later runs only read new models")(f)
+    f = click.option("--jobs", type=int, default=1,
+                     help="How many files to process in parallel")(f)
+    f = click.option("--violation-padding", type=float, default=0.0,
+                     help="How much (relative) a restraint may be violated by")(f)
+    f = click.option("--stat", "stat_names", multiple=True, type=click.Choice(sorted(statistics)),
+                     help="Which statistics to calculate (or all if none provided)")(f)
+    return f
+
+def stat_kwargs(stat_names, **options):
+    return {stat: {k: options[v] for k, v in statistic_options[stat].items()}
+            for stat in sorted(stat_names or statistics)}
 
 @cli.command()
 @click.argument("nucs", type=Path, nargs=-1, required=True)
-@click.option("--structure", default="0", help="Which structure in the file to read")
+@click.option("--structure", default="0",
+              help="Which structure in the file to read ('all', or a comma-separated list)")
 @click.option("--param", multiple=True, help="Which calculation parameters to print")
-@click.option("--violation-padding", type=float, default=0.0,
-              help="How much (relative) a restraint may be violated by")
-def stats(nucs, structure, param, violation_padding):
-    import csv
-    from sys import stdout
-
-    stat_names = {"scale": {}, "violations": {'padding': violation_padding}}
+@stat_options
+@output_options()
+def stats(nucs, structure, param, stat_names, violation_padding, jobs, store, precision,
+          output_format, output):
+    kwargs = stat_kwargs(stat_names, violation_padding=violation_padding)
     stat_cols = list(chain.from_iterable(
-        ("{}_mean".format(s), "{}_std".format(s)) for s in sorted(stat_names)
+        ("{}_mean".format(s), "{}_std".format(s)) for s in kwargs
     ))
 
-    writer = csv.DictWriter(stdout, ["filename"] + stat_cols + list(param))
-    writer.writeheader()
-    for nuc in nucs:
-        with HDFFile(nuc, "r") as f:
-            params = f['structures'][structure]['calculation'].attrs
-            params = {k: params[k] for k in param}
-            if "particle_sizes" in params:
-                params["particle_sizes"] = params["particle_sizes"][-1]
+    tag = multiple_structures(structure)
+    columns = OrderedDict((name, []) for name in ["filename"] + (["structure"] if tag else [])
+                          + stat_cols + list(param))
+    # Structures of a file can't be written to from several processes at once
+    tasks = list(structure_tasks(nucs, structure, 1 if store else jobs))
+    results = parallel_starmap(partial(cached, current_cache(), file_stats, params=tuple(param),
+                                       stat_kwargs=kwargs, store=store, precision=precision),
+                               tasks, jobs)
+    for (nuc, _), nuc_results in zip(tasks, results):
+        for structure_name, params, stat_values in nuc_results:
             params["filename"] = str(nuc.name)
-
-            for stat, kwargs in sorted(stat_names.items()):
-                stat_values = globals()[stat](f, structure, **kwargs)
-                params["{}_mean".format(stat)] = np.mean(stat_values)
-                params["{}_std".format(stat)] = np.std(stat_values)
-            writer.writerow(params)
+            if tag:
+                params["structure"] = structure_name
+            for stat, values in stat_values.items():
+                params["{}_mean".format(stat)] = np.mean(values)
+                params["{}_std".format(stat)] = np.std(values)
+            for name, column in columns.items():
+                column.append(params[name])
+    write_table(columns, output_format, output)
 
 @cli.command()
 @click.argument("nucs", type=Path, nargs=-1, required=True)
 @click.option("--structure", default="0", help="Which structure in the file to read")
 @click.option("--param", help="Which calculation parameter to plot against")
-@click.option("--violation-padding", type=float, default=0.0,
-              help="How much (relative) a restraint may be violated by")
-def plot_stats(nucs, structure, param, violation_padding):
+@stat_options
+def plot_stats(nucs, structure, param, stat_names, violation_padding, jobs, store, precision):
     import matplotlib.pyplot as plt
 
-    stat_names = {"scale": {}, "violations": {'padding': violation_padding}}
-    stats = defaultdict(lambda: np.empty((len(nucs), 3), dtype='float'))
+    kwargs = stat_kwargs(stat_names, violation_padding=violation_padding)
+    stats = {stat: np.empty((len(nucs), 3), dtype='float') for stat in kwargs}
 
-    fig, axs = plt.subplots(len(stat_names), 1)
+    fig, axs = plt.subplots(len(stats), 1, squeeze=False)
 
-    for (i, nuc), (stat, kwargs) in cartesian(enumerate(nucs), stat_names.items()):
-        with HDFFile(nuc, "r") as f:
-            param_value = f['structures'][structure]['calculation'].attrs[param]
-            if param_value == "particle_sizes":
-                param_value["particle_sizes"] = param_value["particle_sizes"][-1]
-            stat_values = globals()[stat](f, structure, **kwargs)
-            stats[stat][i] = [param_value, np.mean(stat_values), np.std(stat_values)]
+    results = parallel_map(partial(cached, current_cache(), file_stats, structures=(structure,),
+                                   params=(param,), stat_kwargs=kwargs, store=store,
+                                   precision=precision), nucs, jobs)
+    for i, ((_, params, stat_values),) in enumerate(results):
+        for stat, values in stat_values.items():
+            stats[stat][i] = [params[param], np.mean(values), np.std(values)]
 
-    for ax, (stat_name, data) in zip(axs, stats.items()):
+    for ax, (stat_name, data) in zip(axs[:, 0], stats.items()):
         ax.set_ylabel(stat_name)
         ax.set_xlabel(param)
         data = np.sort(data, axis=0)
         ax.errorbar(data.T[0], data.T[1], yerr=data.T[2])
     fig.tight_layout()
     plt.show()
+
+@cli.command()
+@click.argument("nuc", type=Path, required=True)
+@click.option("--structure", default="0", help="Which structure in the file to read")
+@click.option("--violation-padding", type=float, multiple=True, default=[0.0],
+              help="How much (relative) a restraint may be violated by (may be repeated)")
+def restraint_violations(nuc, structure, violation_padding):
+    import csv
+    from sys import stdout
+
+    paddings = sorted(violation_padding)
+    with NucFile.open(nuc, structure) as nucfile, timed_file(nuc):
+        index = nucfile.restraint_index
+        nrestraints = len(index['dists'])
+        counts = np.zeros((len(paddings), nrestraints), dtype='int')
+        max_violation = np.zeros(nrestraints)
+        with stage("violations"):
+            # One block of restraints at a time, never all of them for every model
+            start = 0
+            for relative in violation_blocks(nucfile):
+                block = slice(start, start + relative.shape[1])
+                for count, p in zip(counts, paddings):
+                    count[block] = np.count_nonzero(relative > p, axis=0)
+                max_violation[block] = np.maximum(np.max(relative, axis=0, initial=-np.inf), 0.0)
+                start = block.stop
+            fractions = counts / nucfile.nmodels
+
+    with stage("output"):
+        writer = csv.writer(stdout)
+        writer.writerow(["chr_a", "chr_b", "index_a", "index_b", "lower", "upper", "max_violation"]
+                        + ["violated_{}".format(p) for p in paddings])
+        writer.writerows(zip(
+            *index['chromosomes'].T, *index['indices'].T.tolist(),
+            *index['dists'].T.tolist(), max_violation.tolist(), *(f.tolist() for f in fractions)
+        ))
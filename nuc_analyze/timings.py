@@ -0,0 +1,169 @@
+import json
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+# The active Timings instance, if any. Every stage is a no-op when it is None.
+active = None
+_noop = nullcontext()
+
+# Bytes read from /proc by the measurements below, which rchar counts too
+_overhead = 0
+
+def proc_lines(name):
+    global _overhead
+    try:
+        with open(name, "rb") as f:
+            data = f.read()
+    except OSError:
+        return []
+    _overhead += len(data)
+    return data.decode().splitlines()
+
+def read_bytes():
+    # Bytes read by this process so far by read() (including from the page
+    # cache), other than to take these measurements. Reads of memory-mapped
+    # files (such as exported sidecars) are page faults, so aren't counted.
+    overhead = _overhead
+    for line in proc_lines("/proc/self/io"):
+        if line.startswith("rchar:"):
+            return int(line.split()[1]) - overhead
+    return 0
+
+def max_rss():
+    # Peak resident memory of this process in bytes (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def memory_status(field):
+    # A memory field of /proc/self/status (e.g. VmRSS) in bytes, or None
+    for line in proc_lines("/proc/self/status"):
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    return None
+
+def reset_peak_rss():
+    # Reset the peak resident memory in /proc/self/status (VmHWM, not ru_maxrss)
+    # to the current resident memory, returning whether that's possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+class Timings:
+    # Wall time, bytes read and memory of each stage, per input file. A stage's
+    # rss_increase is how far resident memory peaked above its value at the start
+    # of the stage. Where the peak can't be reset (other than on Linux), it is how
+    # far the stage raised the process's peak, so misses stages that stay under it.
+    def __init__(self):
+        self.records = {}
+        self.stages = []
+        self.peaks = []
+        self.nuc = None
+
+    def add(self, key, wall, nbytes, rss_increase, calls=1):
+        record = self.records.setdefault(key, {'wall': 0.0, 'read_bytes': 0, 'calls': 0,
+                                               'rss_increase': 0})
+        record['wall'] += wall
+        record['read_bytes'] += nbytes
+        record['calls'] += calls
+        record['rss_increase'] = max(record['rss_increase'], rss_increase)
+
+    @contextmanager
+    def stage(self, name):
+        self.stages.append(name)
+        key = (self.nuc, "/".join(self.stages))
+        # Resetting the peak loses it for enclosing stages, so keep their peaks so far
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], memory_status("VmHWM") or max_rss())
+        reset = reset_peak_rss()
+        start_rss = memory_status("VmRSS") if reset else max_rss()
+        self.peaks.append(start_rss)
+        start_bytes = read_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            nbytes = read_bytes() - start_bytes
+            peak = max(self.peaks.pop(), memory_status("VmHWM") if reset else max_rss())
+            self.add(key, wall, nbytes, peak - start_rss)
+            self.stages.pop()
+
+    @contextmanager
+    def file(self, nuc):
+        prev, self.nuc = self.nuc, str(nuc)
+        try:
+            yield
+        finally:
+            self.nuc = prev
+
+    def merge(self, records):
+        for key, record in records.items():
+            self.add(key, record['wall'], record['read_bytes'], record['rss_increase'],
+                     record['calls'])
+
+    def report(self):
+        files = {}
+        total = {}
+        for (nuc, stage), record in sorted(self.records.items(), key=lambda x: (str(x[0][0]), x[0][1])):
+            if nuc is not None:
+                files.setdefault(nuc, {})[stage] = record
+            t = total.setdefault(stage, {'wall': 0.0, 'read_bytes': 0, 'calls': 0,
+                                         'rss_increase': 0})
+            for k in ('wall', 'read_bytes', 'calls'):
+                t[k] += record[k]
+            t['rss_increase'] = max(t['rss_increase'], record['rss_increase'])
+        # The peak of the whole (parent) process, not of any stage
+        return {'files': files, 'total': total, 'process_max_rss': max_rss()}
+
+    def dump(self, f):
+        json.dump(self.report(), f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def stage(name):
+    if active is None:
+        return _noop
+    return active.stage(name)
+
+def file(nuc):
+    if active is None:
+        return _noop
+    return active.file(nuc)
+
+def enable():
+    global active
+    active = Timings()
+    return active
+
+def disable(f=None):
+    # Stop recording, writing the report to f if given
+    global active
+    if active is not None and f is not None:
+        active.dump(f)
+    active = None
+
+def collect(f, *args, **kwargs):
+    # Run f with timings enabled (e.g. in a worker process), returning its result
+    # along with the records for merging into the parent's timings
+    global active
+    prev, active = active, Timings()
+    try:
+        return f(*args, **kwargs), active.records
+    finally:
+        active = prev
+
+def wrap(f):
+    # Wrap f for use in a worker process if timings are enabled
+    if active is None:
+        return f
+    return partial(collect, f)
+
+def unwrap(result):
+    if active is None:
+        return result
+    result, records = result
+    active.merge(records)
+    return result
@@ -26,3 +26,26 @@ def unflatten_dict(it):
 
 def ceil_div(x, y):
     return x // y + (x % y != 0)
+
+def parallel_map(f, it, jobs=1):
+    # As map, but spread over a pool of processes. Results stay in input order.
+    if jobs <= 1:
+        yield from map(f, it)
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from . import timings
+    # Forking a process with running threads (e.g. from compiled kernels) can
+    # deadlock, so start workers from a clean process where possible
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+        yield from map(timings.unwrap, pool.map(timings.wrap(f), it))
+
+def starcall(f, args):
+    return f(*args)
+
+def parallel_starmap(f, it, jobs=1):
+    # As parallel_map, but unpacking each item of it into the arguments of f
+    from functools import partial
+    return parallel_map(partial(starcall, f), it, jobs)
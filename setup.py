@@ -7,5 +7,6 @@ setup(
     version="0.1.5",
     description="A tool to collect stats about Hi-C structures",
     packages=['nuc_analyze'],
+    extras_require={'jit': ['numba'], 'parquet': ['pyarrow']},
     entry_points={'console_scripts': ['nuc_analyze=nuc_analyze.main:cli']}
 )
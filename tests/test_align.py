@@ -118,3 +118,81 @@ def test_commandline_median(nucfile, runner):
         coords = f['structures']['0']['coords']
         for expected, (_, coords) in zip(expected, sorted(coords.items())):
             np.testing.assert_allclose(expected, coords, atol=1e-14)
+
+def test_superpose():
+    from scipy.spatial.transform import Rotation
+
+    rng = np.random.RandomState(2)
+    ref = rng.normal(size=(10, 3))
+    rotations = Rotation.random(4, random_state=rng).as_matrix()
+    # Include a mirror image
+    rotations[-1] *= -1
+    translations = rng.normal(size=(4, 3))
+    coords = transform(np.broadcast_to(ref, (4, 10, 3)), rotations, translations)
+
+    R, t = superpose(ref, coords)
+    np.testing.assert_allclose(transform(coords, R, t), np.broadcast_to(ref, (4, 10, 3)),
+                               atol=1e-12)
+
+    R, t = superpose(ref, coords, mirror=False)
+    np.testing.assert_allclose(np.linalg.det(R), 1.0)
+    np.testing.assert_allclose(transform(coords, R, t)[:-1], np.broadcast_to(ref, (3, 10, 3)),
+                               atol=1e-12)
+
+@pytest.mark.parametrize("target", ["0", "1", "median"])
+def test_memory_budget(nucfile, tmpdir, runner, target):
+    import shutil
+
+    budget_nucfile = tmpdir.join("budget.nuc")
+    shutil.copy(str(nucfile), str(budget_nucfile))
+
+    result = runner.invoke(align, [str(nucfile), "--target", target])
+    assert result.exit_code == 0
+    # Room for one particle of two models, and its median or transform, at a time
+    args = [str(budget_nucfile), "--target", target, "--memory-budget", str(96 / 2 ** 20)]
+    result = runner.invoke(align, args)
+    assert result.exit_code == 0
+
+    with h5py.File(str(nucfile), "r") as f, h5py.File(str(budget_nucfile), "r") as g:
+        for chromosome, coords in f['structures']['0']['coords'].items():
+            np.testing.assert_allclose(coords, g['structures']['0']['coords'][chromosome],
+                                       atol=1e-12)
+
+@pytest.mark.parametrize("target", ["0", "median"])
+def test_memory_budget_peak(tmpdir, runner, target):
+    import tracemalloc
+
+    filename = tmpdir.join("large.nuc")
+    coords = np.random.RandomState(2).normal(size=(64, 4096, 3))
+    with h5py.File(str(filename), "w") as f:
+        f.create_dataset('structures/0/coords/chr1', data=coords, chunks=(64, 256, 3))
+
+    budget = 2 ** 20
+    tracemalloc.start()
+    try:
+        result = runner.invoke(align, [str(filename), "--target", target,
+                                       "--memory-budget", str(budget / 2 ** 20)])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert result.exit_code == 0
+    assert peak < budget + 2 ** 18
+    assert peak < coords.nbytes / 4
+
+@pytest.mark.parametrize("target", ["0", "median"])
+def test_precision(nucfile, tmpdir, runner, target):
+    import shutil
+
+    single_nucfile = tmpdir.join("single.nuc")
+    shutil.copy(str(nucfile), str(single_nucfile))
+
+    result = runner.invoke(align, [str(nucfile), "--target", target])
+    assert result.exit_code == 0
+    result = runner.invoke(align, [str(single_nucfile), "--target", target,
+                                   "--precision", "float32"])
+    assert result.exit_code == 0
+
+    with h5py.File(str(nucfile), "r") as f, h5py.File(str(single_nucfile), "r") as g:
+        for chromosome, coords in f['structures']['0']['coords'].items():
+            np.testing.assert_allclose(coords, g['structures']['0']['coords'][chromosome],
+                                       atol=1e-5)
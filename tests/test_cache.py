@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from h5py import File as HDFFile
+from click.testing import CliRunner
+
+from nuc_analyze.cache import *
+
+calls = []
+
+def count(nuc, offset=0):
+    calls.append(nuc)
+    return len(calls) + offset
+
+def test_cache(tmpdir):
+    nuc = tmpdir.join("test.nuc")
+    nuc.write("foo")
+    cache = Cache(tmpdir.join("cache"))
+    del calls[:]
+
+    assert cache(count, nuc) == 1
+    assert cache(count, nuc) == 1
+    assert cache(count, nuc, offset=1) == 3
+    assert len(calls) == 2
+
+    nuc.write("foobar")
+    assert cache(count, nuc) == 3
+
+    cache.clear()
+    assert cache(count, nuc) == 4
+
+def test_cached_disabled(tmpdir):
+    nuc = tmpdir.join("test.nuc")
+    del calls[:]
+    assert cached(None, count, nuc) == 1
+    assert cached(None, count, nuc) == 2
+
+def test_evict(tmpdir):
+    cache = Cache(tmpdir.join("cache"), max_size=1000)
+    for i in range(10):
+        cache.put(str(i), bytes(200))
+    assert sum(p.stat().st_size for p in cache.entries()) <= 1000
+    assert cache.get("9") == bytes(200)
+
+def test_get_evicted(tmpdir, monkeypatch):
+    cache = Cache(tmpdir.join("cache"))
+    cache.put("foo", 1)
+
+    def utime(path):
+        # Another process evicts the entry between reading and touching it
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, "utime", utime)
+    assert cache.get("foo") == 1
+
+def test_cache_cli(tmpdir):
+    from nuc_analyze.main import cli
+
+    nuc = tmpdir.join("test.nuc")
+    with HDFFile(str(nuc), 'w') as f:
+        f.create_dataset('structures/0/coords/1', data=np.array(
+            [[[0, 0, 0], [0, 0, 0]], [[0, 0, 0], [1, 0, 0]]]
+        ))
+        f.create_dataset('structures/0/particles/1/positions', data=np.array([10, 200]))
+    cache_dir = tmpdir.join("cache")
+
+    runner = CliRunner()
+    args = ["--cache-dir", str(cache_dir), "rmsd", str(nuc)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    assert len(cache_dir.listdir()) == 1
+    assert runner.invoke(cli, args).output == result.output
+
+    result = runner.invoke(cli, ["--cache-dir", str(cache_dir), "clear-cache"])
+    assert result.exit_code == 0
+    assert len(cache_dir.listdir()) == 0
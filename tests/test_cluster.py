@@ -48,3 +48,142 @@ def test_commandline(nucfile, tmpdir, runner):
     args = [str(nucfile), "--output", str(tmpdir.join("foo.pdf"))]
     result = runner.invoke(plot_clusters, args)
     assert result.exit_code == 0
+
+def test_pairwise_rmsd():
+    from scipy.spatial.distance import pdist
+
+    coords = np.random.RandomState(4).normal(size=(7, 5, 3)) + 100.0
+    expected = pdist(coords.reshape(7, -1), metric=distance)
+
+    np.testing.assert_allclose(pairwise_rmsd(coords), expected, rtol=1e-9)
+    np.testing.assert_allclose(pairwise_rmsd(coords, block_size=3), expected, rtol=1e-9)
+
+def test_linkage(nucfile):
+    from scipy.spatial.distance import pdist
+
+    with h5py.File(str(nucfile), "r") as f:
+        coords = np.concatenate(list(f['structures']['0']['coords'].values()), axis=1)
+    expected = hierarchy.linkage(
+        coords.reshape(coords.shape[0], -1), method='single', metric=distance
+    )
+
+    np.testing.assert_allclose(linkage(str(nucfile), "0"), expected)
+
+def test_mst_linkage():
+    from scipy.spatial.distance import pdist
+
+    coords = np.random.RandomState(3).normal(size=(30, 5, 3))
+    expected = hierarchy.linkage(pdist(coords.reshape(30, -1), metric=distance), method='single')
+
+    np.testing.assert_allclose(mst_linkage(coords), expected)
+
+@pytest.mark.parametrize("method", linkage_methods)
+def test_linkage_methods(nucfile, tmpdir, method):
+    from scipy.spatial.distance import pdist
+
+    with h5py.File(str(nucfile), "r") as f:
+        coords = np.concatenate(list(f['structures']['0']['coords'].values()), axis=1)
+    expected = hierarchy.linkage(
+        pdist(coords.reshape(coords.shape[0], -1), metric=distance), method=method
+    )
+
+    np.testing.assert_allclose(linkage(str(nucfile), "0", method=method), expected)
+    scratch_dir = tmpdir.mkdir("scratch")
+    np.testing.assert_allclose(
+        linkage(str(nucfile), "0", method=method, scratch_dir=scratch_dir), expected
+    )
+    assert scratch_dir.listdir() == []
+
+def test_single_linkage_scratch(nucfile, tmpdir, monkeypatch):
+    from nuc_analyze import cluster
+
+    expected = linkage(str(nucfile), "0", method='single')
+
+    def pairwise_rmsd(*args, **kwargs):
+        raise AssertionError("Single linkage shouldn't build the distance matrix")
+    monkeypatch.setattr(cluster, "pairwise_rmsd", pairwise_rmsd)
+    scratch_dir = tmpdir.mkdir("scratch")
+    np.testing.assert_allclose(
+        linkage(str(nucfile), "0", method='single', scratch_dir=scratch_dir), expected
+    )
+
+@pytest.mark.parametrize("method", ["single", "average"])
+def test_store(nucfile, method):
+    expected = linkage(str(nucfile), "0", method=method)
+    np.testing.assert_allclose(linkage(str(nucfile), "0", method=method, store=True), expected)
+
+    path = 'analysis/clusters/0/{}'.format(method)
+    with h5py.File(str(nucfile), "r+") as f:
+        np.testing.assert_allclose(f[path]['linkage'], expected)
+        np.testing.assert_allclose(f[path]['distances'], [np.sqrt(1 / 3)])
+        # Stored results are used while the coordinates are unchanged
+        f[path]['linkage'][0, 2] = 10.0
+    assert linkage(str(nucfile), "0", method=method)[0, 2] == 10.0
+
+    with h5py.File(str(nucfile), "r+") as f:
+        f['structures/0/coords/chr1'][0, 0] += 1.0
+    assert linkage(str(nucfile), "0", method=method)[0, 2] != 10.0
+    assert linkage(str(nucfile), "0", method=method, store=True)[0, 2] != 10.0
+    assert linkage(str(nucfile), "0", method=method)[0, 2] != 10.0
+
+def test_store_sampled(tmpdir):
+    from nuc_analyze import timings
+
+    p = str(tmpdir.join("test.nuc"))
+    coords = np.random.RandomState(7).normal(size=(500, 200, 3))
+    with h5py.File(p, "w") as f:
+        f.create_dataset('structures/0/coords/chr1', data=coords)
+    expected = linkage(p, "0", method='average', store=True)
+
+    t = timings.enable()
+    try:
+        np.testing.assert_allclose(linkage(p, "0", method='average'), expected)
+    finally:
+        timings.disable()
+    # Checking the stored linkage is current doesn't read every model
+    total = t.report()['total']
+    assert 'distance' not in total
+    assert total['hash/read']['read_bytes'] < coords.nbytes / 10
+
+def test_extend_distances():
+    from scipy.spatial.distance import pdist
+
+    coords = np.random.RandomState(5).normal(size=(9, 4, 3))
+    expected = pdist(coords.reshape(9, -1), metric=distance)
+    for stored in [1, 2, 6, 9]:
+        out = np.empty_like(expected)
+        extend_distances(pairwise_rmsd(coords[:stored]), coords, out, block_size=4)
+        np.testing.assert_allclose(out, expected, rtol=1e-9)
+
+def test_store_appended(tmpdir):
+    from scipy.spatial.distance import pdist
+
+    coords = np.random.RandomState(6).normal(size=(8, 4, 3))
+    p = str(tmpdir.join("test.nuc"))
+    with h5py.File(p, "w") as f:
+        f.create_dataset('structures/0/coords/chr1', data=coords[:5], maxshape=(None, 4, 3))
+    linkage(p, "0", method='average', store=True)
+
+    with h5py.File(p, "r+") as f:
+        dataset = f['structures/0/coords/chr1']
+        dataset.resize(8, axis=0)
+        dataset[5:] = coords[5:]
+        # Stored distances between existing models are reused
+        f['analysis/clusters/0/average/distances'][0] = 0.0
+    linkage(p, "0", method='average', store=True)
+
+    expected = pdist(coords.reshape(8, -1), metric=distance)
+    expected[0] = 0.0
+    with h5py.File(p, "r") as f:
+        np.testing.assert_allclose(f['analysis/clusters/0/average/distances'], expected)
+        assert f['analysis/clusters/0/average'].attrs['nmodels'] == 8
+
+def test_commandline_truncated(tmpdir, runner):
+    p = str(tmpdir.join("test.nuc"))
+    with h5py.File(p, "w") as f:
+        f.create_dataset('structures/0/coords/chr1',
+                         data=np.random.RandomState(7).normal(size=(20, 4, 3)))
+    output = tmpdir.join("foo.svg")
+    result = runner.invoke(plot_clusters, [p, "--output", str(output), "--max-leaves", "5"])
+    assert result.exit_code == 0
+    assert output.check()
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import h5py
+from click.testing import CliRunner
+
+from nuc_analyze.cluster import distance
+
+@pytest.fixture()
+def nucs(tmpdir):
+    rng = np.random.RandomState(0)
+    files = [str(tmpdir.join("a.nuc")), str(tmpdir.join("b.nuc"))]
+    coords = {'a': {'1': rng.normal(size=(5, 4, 3)), '2': rng.normal(size=(5, 3, 3)),
+                    'X': rng.normal(size=(5, 2, 3))},
+              'b': {'1': rng.normal(size=(7, 3, 3)), '2': rng.normal(size=(7, 3, 3))}}
+    positions = {'a': {'1': [0, 10, 20, 30], '2': [5, 15, 25], 'X': [0, 1]},
+                 'b': {'1': [30, 10, 40], '2': [100, 200, 300]}}
+    for p, name in zip(files, 'ab'):
+        with h5py.File(p, "w") as f:
+            for chromo, data in coords[name].items():
+                f.create_dataset('structures/0/coords/{}'.format(chromo), data=data)
+                f.create_dataset('structures/0/particles/{}/positions'.format(chromo),
+                                 data=positions[name][chromo])
+    # Positions 10 and 30 of chromosome 1 are the only ones in both
+    shared_a = coords['a']['1'][:, [1, 3]]
+    shared_b = coords['b']['1'][:, [1, 0]]
+    expected = np.array([[distance(x, y) for y in shared_b] for x in shared_a])
+    return files, shared_a, shared_b, expected
+
+def test_cross_rmsd(nucs):
+    from nuc_analyze.nucfile import NucFile
+    from nuc_analyze.compare import cross_rmsd
+
+    (a, b), _, _, expected = nucs
+    with NucFile.open(a) as a, NucFile.open(b) as b:
+        for budget in [None, 1]:
+            out = np.full(expected.shape, np.nan)
+            cross_rmsd(a, b, out, budget=budget)
+            np.testing.assert_allclose(out, expected, rtol=1e-9)
+
+@pytest.mark.parametrize("superpose", [False, True])
+def test_cross_rmsd_budget(tmpdir, superpose):
+    import tracemalloc
+    from nuc_analyze.nucfile import NucFile
+    from nuc_analyze.compare import cross_rmsd
+    from nuc_analyze import kernels
+
+    rng = np.random.RandomState(1)
+    files = [str(tmpdir.join("a.nuc")), str(tmpdir.join("b.nuc"))]
+    for p, nmodels in zip(files, [300, 200]):
+        with h5py.File(p, "w") as f:
+            f.create_dataset('structures/0/coords/1', data=rng.normal(size=(nmodels, 60, 3)))
+            f.create_dataset('structures/0/particles/1/positions', data=np.arange(60))
+    # Compile or import kernels before measuring
+    kernels.rmsd_matrix(np.ones((1, 3)), np.ones((1, 3)))
+    kernels.superposed_rmsd_matrix(np.ones((1, 2, 3)), np.ones((1, 2, 3)))
+
+    budget = 2 ** 19
+    with NucFile.open(files[0]) as a, NucFile.open(files[1]) as b:
+        expected = cross_rmsd(a, b, np.empty((300, 200)), superpose=superpose)
+        out = np.empty((300, 200))
+        tracemalloc.start()
+        try:
+            cross_rmsd(a, b, out, superpose=superpose, budget=budget)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    np.testing.assert_allclose(out, expected, rtol=1e-9)
+    assert peak < budget
+
+def test_cross_rmsd_cli(nucs, tmpdir):
+    from nuc_analyze.main import cli
+    from nuc_analyze import kernels
+
+    (a, b), shared_a, shared_b, expected = nucs
+    runner = CliRunner()
+
+    output = tmpdir.join("rmsd.npy")
+    result = runner.invoke(cli, ["cross-rmsd", a, b, "--output", str(output)])
+    assert result.exit_code == 0
+    np.testing.assert_allclose(np.load(str(output)), expected, rtol=1e-9)
+
+    output = tmpdir.join("rmsd.h5")
+    args = ["cross-rmsd", a, b, "--output", str(output), "--superpose", "--memory-budget", "0"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    with h5py.File(str(output), "r") as f:
+        np.testing.assert_allclose(
+            f['rmsd'], kernels.superposed_rmsd_matrix(shared_a, shared_b), rtol=1e-9
+        )
+        assert f.attrs['superposed']
+
+    result = runner.invoke(cli, ["cross-rmsd", a, a, "--output", str(output)])
+    assert result.exit_code == 0
+    with h5py.File(str(output), "r") as f:
+        assert f['rmsd'].shape == (5, 5)
+        np.testing.assert_allclose(np.diag(f['rmsd']), 0.0, atol=1e-7)
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import pytest
+
+from nuc_analyze import kernels
+
+@pytest.fixture(params=sorted(kernels.backends))
+def backend(request):
+    prev = kernels.backend
+    kernels.use(request.param)
+    yield request.param
+    kernels.use(prev)
+
+def test_fallback():
+    assert 'numpy' in kernels.backends
+    with pytest.raises(ValueError):
+        kernels.use('foo')
+
+def test_numba_not_imported():
+    import subprocess
+    import sys
+
+    # Selecting NumPy, or not calling any kernel, never imports Numba
+    code = "import sys; from nuc_analyze import kernels; assert 'numba' not in sys.modules"
+    for env in [{}, {'NUC_ANALYZE_BACKEND': 'numpy'}]:
+        subprocess.check_call([sys.executable, "-c", code], env=dict(os.environ, **env))
+
+def test_rmsd_matrix(backend):
+    from scipy.spatial.distance import cdist
+    rng = np.random.RandomState(0)
+    a, b = rng.normal(size=(4, 30)), rng.normal(size=(6, 30))
+
+    expected = cdist(a, b) / np.sqrt(30)
+    np.testing.assert_allclose(kernels.rmsd_matrix(a, b), expected, rtol=1e-10)
+
+def test_slab_moments(backend):
+    slab = np.random.RandomState(1).normal(size=(5, 7, 3))
+
+    mean, m2 = kernels.slab_moments(slab)
+    np.testing.assert_allclose(mean, np.mean(slab, axis=0))
+    np.testing.assert_allclose(m2, np.sum(np.var(slab, axis=0), axis=-1) * 5)
+
+def test_violation_counts(backend):
+    rng = np.random.RandomState(2)
+    a_coords, b_coords = rng.normal(size=(2, 5, 8, 3))
+    indices = rng.randint(8, size=(20, 2))
+    lower, upper = np.sort(rng.uniform(0, 3, size=(2, 20)), axis=0)
+
+    dist = np.linalg.norm(a_coords[:, indices[:, 0]] - b_coords[:, indices[:, 1]], axis=-1)
+    for padding in [0.0, 0.2]:
+        expected = np.sum((dist > upper * (1 + padding)) | (dist < lower * (1 - padding)), axis=1)
+        np.testing.assert_equal(
+            kernels.violation_counts(a_coords, b_coords, indices, lower, upper, padding), expected
+        )
+
+def test_backends_agree():
+    if 'numba' not in kernels.backends:
+        pytest.skip("numba is not installed")
+    from nuc_analyze.cluster import pairwise_rmsd
+    from nuc_analyze.rmsd import moments
+
+    coords = np.random.RandomState(3).normal(size=(9, 11, 3))
+    results = []
+    prev = kernels.backend
+    try:
+        for backend in ['numpy', 'numba']:
+            kernels.use(backend)
+            results.append((pairwise_rmsd(coords, block_size=4),
+                            moments([coords[:4], coords[4:]])))
+    finally:
+        kernels.use(prev)
+    (distances, (n, mean, m2)), (numba_distances, (numba_n, numba_mean, numba_m2)) = results
+    np.testing.assert_allclose(numba_distances, distances, rtol=1e-10)
+    assert n == numba_n
+    np.testing.assert_allclose(numba_mean, mean)
+    np.testing.assert_allclose(numba_m2, m2)
+
+@pytest.mark.parametrize("mirror", [True, False])
+def test_superposed_rmsd_matrix(backend, mirror):
+    from nuc_analyze.align import superpose, transform
+    rng = np.random.RandomState(3)
+    a, b = rng.normal(size=(3, 10, 3)), rng.normal(size=(4, 10, 3))
+    b[0] = -a[0] + 2.0
+
+    expected = np.empty((3, 4))
+    for i, ref in enumerate(a):
+        aligned = transform(b, *superpose(ref, b, mirror=mirror))
+        expected[i] = np.sqrt(np.mean((aligned - ref) ** 2, axis=(1, 2)))
+    result = kernels.superposed_rmsd_matrix(a, b, mirror=mirror)
+    np.testing.assert_allclose(result, expected, rtol=1e-7, atol=1e-7)
+    assert (result[0, 0] < 1e-6) == mirror
+
+eps32 = np.finfo(np.float32).eps
+
+@pytest.mark.parametrize("noise", [1.0, 1e-3])
+def test_rmsd_matrix_float32(backend, noise):
+    rng = np.random.RandomState(4)
+    coords = (rng.normal(size=(1, 500, 3)) * 10 + 50 + rng.normal(size=(8, 500, 3)) * noise)
+    a, b = coords.astype(np.float32), coords.astype(np.float32).astype(np.float64)
+    bound = np.sqrt(3 * 500) * eps32
+
+    flat = b.reshape(8, -1) - np.mean(b.reshape(8, -1), axis=0)
+    sq = np.mean(flat ** 2, axis=1)
+    flat32 = flat.astype(np.float32)
+    error = np.abs(kernels.rmsd_matrix(flat32, flat32) ** 2 - kernels.rmsd_matrix(flat, flat) ** 2)
+    assert np.all(error <= bound * (sq[:, None] + sq[None, :]))
+
+    centered = b - np.mean(b, axis=1, keepdims=True)
+    sq = np.mean(centered ** 2, axis=(1, 2))
+    error = np.abs(kernels.superposed_rmsd_matrix(a, a) ** 2
+                   - kernels.superposed_rmsd_matrix(b, b) ** 2)
+    assert np.all(error <= bound * (sq[:, None] + sq[None, :]))
+
+def test_slab_moments_float32(backend):
+    from nuc_analyze.rmsd import moments
+    rng = np.random.RandomState(5)
+    coords = (rng.normal(size=(1, 50, 3)) * 10 + 100 + rng.normal(size=(40, 50, 3)))
+    a, b = coords.astype(np.float32), coords.astype(np.float32).astype(np.float64)
+
+    n, mean, m2 = moments([b[:25], b[25:]])
+    expected = np.sqrt(m2 / n)
+    n, _, m2 = moments([a[:25], a[25:]])
+    bound = 8 * eps32 * (1 + np.linalg.norm(mean, axis=-1) / expected)
+    assert np.all(np.abs(np.sqrt(m2 / n) - expected) / expected <= bound)
+
+def test_violation_counts_float32(backend):
+    rng = np.random.RandomState(6)
+    coords = rng.normal(size=(5, 30, 3)) * 10
+    indices = rng.randint(30, size=(100, 2))
+    lower, upper = np.sort(rng.uniform(0, 30, size=(2, 100)), axis=0)
+    dist = np.linalg.norm(coords[:, indices[:, 0]] - coords[:, indices[:, 1]], axis=-1)
+    # Move bounds away from distances, where rounding could change the count
+    near = lambda bound: np.any(np.abs(dist - bound) <= 4 * eps32 * dist, axis=0)
+    keep = ~(near(lower) | near(upper))
+    indices, lower, upper = indices[keep], lower[keep], upper[keep]
+
+    expected = kernels.violation_counts(coords, coords, indices, lower, upper, 0.0)
+    a = coords.astype(np.float32)
+    result = kernels.violation_counts(a, a, indices, lower.astype(np.float32),
+                                      upper.astype(np.float32), 0.0)
+    np.testing.assert_equal(result, expected)
@@ -0,0 +1,30 @@
+import sys
+import subprocess
+from click.testing import CliRunner
+
+def test_lazy_help():
+    # Listing the commands shouldn't import any of them
+    code = "\n".join([
+        "import sys",
+        "from nuc_analyze.main import cli",
+        "try:",
+        "    cli(['--help'])",
+        "except SystemExit:",
+        "    pass",
+        "print(sorted(m for m in ('h5py', 'numpy', 'scipy') if m in sys.modules))",
+    ])
+    output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+    assert output.splitlines()[-1] == "[]"
+
+def test_lazy_commands():
+    from nuc_analyze.main import cli
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    commands = cli.list_commands(None)
+    assert {"align", "plot-clusters", "rmsd", "plot-rmsd", "stats", "plot-stats",
+            "restraint-violations", "cross-rmsd", "export", "repack"} <= set(commands)
+    for command in commands:
+        assert command in result.output
+        assert cli.get_command(None, command).name == command
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+import h5py
+
+from nuc_analyze.nucfile import *
+
+Restraint = np.dtype([('indices', 'int', 2), ('dists', 'float', 2)])
+
+@pytest.fixture()
+def nucfile(tmpdir):
+    filename = tmpdir.join("test.nuc")
+    rng = np.random.RandomState(0)
+    with h5py.File(str(filename), "w") as f:
+        f.create_dataset('structures/0/coords/1', data=rng.normal(size=(5, 4, 3)), chunks=(2, 4, 3))
+        f.create_dataset('structures/0/coords/2', data=rng.normal(size=(5, 3, 3)))
+        f.create_dataset('structures/0/particles/1/positions', data=np.arange(4) * 10)
+        f.create_dataset('structures/0/particles/2/positions', data=np.arange(3) * 10)
+        f.create_dataset('structures/0/restraints/1/1', data=np.array(
+            [((0, 1), (0.0, 1.0))], dtype=Restraint
+        ))
+        f.create_dataset('structures/0/restraints/1/2', data=np.array(
+            [((0, 1), (0.0, 1.0))], dtype=Restraint
+        ))
+    return filename
+
+def test_nucfile(nucfile):
+    with NucFile.open(nucfile) as n, h5py.File(str(nucfile), "r") as f:
+        coords = f['structures/0/coords']
+        assert n.chromosomes == ['1', '2']
+        assert n.nmodels == 5
+        assert n.offsets == {'1': slice(0, 4), '2': slice(4, 7)}
+        np.testing.assert_equal(n.all_coords, np.concatenate([coords['1'], coords['2']], axis=1))
+        np.testing.assert_equal(n.positions('2'), [0, 10, 20])
+        assert sorted(n.restraints) == [('1', '1'), ('1', '2')]
+        assert n.coords('1') is n.coords('1')
+
+def test_nucfile_subset(nucfile):
+    with NucFile.open(nucfile, chromosomes=['1'], models=slice(1, 4)) as n, \
+         h5py.File(str(nucfile), "r") as f:
+        assert n.chromosomes == ['1']
+        assert n.nmodels == 3
+        np.testing.assert_equal(n.all_coords, f['structures/0/coords/1'][1:4])
+        assert list(n.restraints) == [('1', '1')]
+        slabs = list(n.model_slabs('1'))
+        assert [len(s) for s in slabs] == [2, 1]
+        np.testing.assert_equal(np.concatenate(slabs), f['structures/0/coords/1'][1:4])
+
+def test_model_slabs_timings(nucfile):
+    import time
+    from nuc_analyze import timings
+
+    t = timings.enable()
+    try:
+        with NucFile.open(nucfile) as n:
+            for slab in n.model_slabs('1'):
+                time.sleep(0.1)
+    finally:
+        timings.disable()
+    # Time spent on each slab isn't counted as reading it
+    assert t.report()['total']['read']['wall'] < 0.1
+
+def test_slabs(nucfile):
+    with h5py.File(str(nucfile), "r") as f:
+        coords = f['structures/0/coords/1']
+        assert slab_size(coords, axis=0) == 2
+        # 5 models of 3 doubles per particle
+        assert slab_size(coords, axis=1, budget=5 * 3 * 8 * 3) == 3
+        assert slab_size(coords, axis=0, budget=4 * 3 * 8 * 5) == 4
+        assert list(slabs(coords, axis=1, size=3)) == [slice(0, 3), slice(3, 4)]
+        assert list(slabs(coords, axis=1)) == [slice(0, 4)]
+
+def test_sidecar(nucfile):
+    with NucFile.open(nucfile) as n:
+        expected = n.all_coords.copy()
+        fingerprint = n.fingerprint()
+        assert n.sidecar is None
+
+    paths = export_sidecar(nucfile)
+    assert all(p.exists() for p in paths.values())
+    with NucFile.open(nucfile) as n:
+        assert n.sidecar is not None
+        np.testing.assert_equal(n.all_coords, expected)
+        assert np.shares_memory(n.all_coords, n.sidecar['coords'])
+        np.testing.assert_equal(n.positions('2'), [0, 10, 20])
+        assert n.fingerprint() == fingerprint
+        subset = n.select(chromosomes=['2'], models=slice(1, 4))
+        assert subset.sidecar is n.sidecar
+        np.testing.assert_equal(subset.all_coords, expected[1:4, 4:])
+        assert [len(s) for s in n.model_slabs('1')] == [2, 2, 1]
+
+    with h5py.File(str(nucfile), "r+") as f:
+        f['structures/0/coords/1'][0] = 0.0
+    with NucFile.open(nucfile) as n:
+        # Modifying the file makes the sidecar stale
+        assert n.sidecar is None
+        np.testing.assert_equal(n.coords('1')[0], 0.0)
+
+def test_sidecar_no_positions(nucfile):
+    with h5py.File(str(nucfile), "r+") as f:
+        del f['structures/0/particles']
+    paths = export_sidecar(nucfile)
+    assert not paths['positions'].exists()
+    with NucFile.open(nucfile) as n, h5py.File(str(nucfile), "r") as f:
+        assert n.sidecar['positions'] is None
+        np.testing.assert_equal(n.coords('2'), f['structures/0/coords/2'])
+        with pytest.raises(KeyError):
+            n.positions('1')
+
+def test_export_cli(nucfile):
+    from click.testing import CliRunner
+    from nuc_analyze.main import cli
+    from nuc_analyze.rmsd import file_rmsd
+
+    before = file_rmsd(str(nucfile))
+    result = CliRunner().invoke(cli, ["export", str(nucfile)])
+    assert result.exit_code == 0
+    assert result.output == str(sidecar_paths(nucfile)['coords']) + '\n'
+    after = file_rmsd(str(nucfile))
+    for (_, chromo_a, positions_a, rmsd_a), (_, chromo_b, positions_b, rmsd_b) in zip(
+            ((s,) + r for s, rs in before for r in rs), ((s,) + r for s, rs in after for r in rs)):
+        assert chromo_a == chromo_b
+        np.testing.assert_equal(positions_a, positions_b)
+        np.testing.assert_allclose(rmsd_a, rmsd_b)
+
+def test_precision(nucfile):
+    with NucFile.open(nucfile, dtype='float32') as n, h5py.File(str(nucfile), "r") as f:
+        expected = f['structures/0/coords/1'][:]
+        assert n.coords('1').dtype == np.float32
+        np.testing.assert_allclose(n.coords('1'), expected, rtol=1e-6)
+        assert n.all_coords.dtype == np.float32
+        slabs = list(n.select(models=[0, 2, 3]).model_slabs('1'))
+        assert all(s.dtype == np.float32 for s in slabs)
+        np.testing.assert_allclose(np.concatenate(slabs), expected[[0, 2, 3]], rtol=1e-6)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import h5py
+from click.testing import CliRunner
+
+from nuc_analyze.repack import *
+
+@pytest.fixture()
+def nucfile(tmpdir):
+    filename = tmpdir.join("test.nuc")
+    rng = np.random.RandomState(0)
+    with h5py.File(str(filename), "w") as f:
+        f.attrs['version'] = 1
+        f.create_dataset('structures/0/coords/1', data=rng.normal(size=(10, 40, 3)),
+                         chunks=(10, 1, 3))
+        f.create_dataset('structures/0/coords/2', data=rng.normal(size=(10, 7, 3)),
+                         maxshape=(None, 7, 3), fillvalue=2.0)
+        f.create_dataset('structures/0/particles/1/positions', data=np.arange(40))
+        f.create_group('structures/0/calculation').attrs['foo'] = 2
+        f.create_dataset('structures/1/coords/1', data=rng.normal(size=(3, 5, 3)))
+    return filename
+
+def test_chunk_shape():
+    assert chunk_shape((1000, 50000, 3), 'double', 24 * 100) == (10, 10, 3)
+    assert chunk_shape((5, 50000, 3), 'double', 24 * 100) == (5, 20, 3)
+    assert chunk_shape((5, 3, 3), 'double', 24 * 100) == (5, 3, 3)
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_repack(nucfile, tmpdir, compression):
+    with h5py.File(str(nucfile), "r") as f:
+        expected = {name: f[name][:] for name in
+                    ['structures/0/coords/1', 'structures/0/coords/2', 'structures/1/coords/1']}
+
+    output = tmpdir.join("out.nuc")
+    args = [str(nucfile), "--output", str(output), "--compression", compression,
+            "--chunk-size", str(24 * 16 / 2 ** 20)]
+    result = CliRunner().invoke(repack, args)
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert [l.split(':')[0] for l in lines] == ["model reads", "particle reads"]
+
+    with h5py.File(str(output), "r") as f:
+        for name, data in expected.items():
+            np.testing.assert_equal(f[name], data)
+        assert f['structures/0/coords/1'].chunks == (4, 4, 3)
+        assert f['structures/0/coords/1'].compression == (None if compression == "none" else "gzip")
+        assert f.attrs['version'] == 1
+        assert f['structures/0/calculation'].attrs['foo'] == 2
+        np.testing.assert_equal(f['structures/0/particles/1/positions'], np.arange(40))
+
+def test_repack_in_place(nucfile):
+    with h5py.File(str(nucfile), "r") as f:
+        expected = f['structures/0/coords/1'][:]
+    result = CliRunner().invoke(repack, [str(nucfile)])
+    assert result.exit_code == 0
+    assert not nucfile.new(basename="test.nuc.repack").check()
+    with h5py.File(str(nucfile), "r") as f:
+        np.testing.assert_equal(f['structures/0/coords/1'], expected)
+        assert f['structures/0/coords/1'].chunks == (10, 40, 3)
+        assert f['structures/0/coords/1'].compression == 'gzip'
+
+def test_repack_resizable(nucfile):
+    result = CliRunner().invoke(repack, [str(nucfile)])
+    assert result.exit_code == 0
+    with h5py.File(str(nucfile), "r+") as f:
+        coords = f['structures/0/coords/2']
+        assert coords.maxshape == (None, 7, 3)
+        assert coords.fillvalue == 2.0
+        # Models can still be appended
+        coords.resize(12, axis=0)
+        np.testing.assert_equal(coords[10:], 2.0)
+        assert f['structures/0/coords/1'].maxshape == (10, 40, 3)
@@ -30,7 +30,11 @@ def test_rmsd():
     from nuc_analyze.rmsd import rmsd
 
     expected = [('1', [10, 200], [0., 0.5]), ('X', [0, 100], [1.0, 0.5])]
-    np.testing.assert_equal(sorted(rmsd(nucs[0])), sorted(expected))
+    results = sorted(rmsd(nucs[0]), key=lambda r: r[0])
+    assert [chromo for chromo, _, _ in results] == [chromo for chromo, _, _ in expected]
+    for (_, positions, rmsds), (_, expected_positions, expected_rmsds) in zip(results, expected):
+        np.testing.assert_equal(positions, expected_positions)
+        np.testing.assert_allclose(rmsds, expected_rmsds, rtol=1e-12)
 
 def test_rmsd_cli(tmpdir):
     from nuc_analyze.main import cli
@@ -53,3 +57,177 @@ def test_rmsd_cli(tmpdir):
     result = runner.invoke(cli, ["rmsd", str(p)])
     assert result.exit_code == 0
     assert result.output == '\n'.join(expected) + '\n'
+
+    result = runner.invoke(cli, ["rmsd", "--jobs", "2"] + list(map(str, files)))
+    assert result.exit_code == 0
+    assert result.output == '\n'.join(expected) + '\n'
+
+    expected = ["X:100 2.0", "1:10 0.0"]
+    args = ["--position", "X", "100", "--position", "X", "0", "--position", "1", "10"]
+    result = runner.invoke(cli, ["rmsd"] + list(map(str, files)) + args)
+    assert result.exit_code == 0
+    assert result.output == '\n'.join(expected) + '\n'
+
+def test_rmsd_slabs():
+    from nuc_analyze.rmsd import rmsd
+
+    coords = np.random.RandomState(1).normal(size=(7, 5, 3)) + 1000.0
+    nuc = {'structures': {'0': {
+        'coords': {'1': coords},
+        'particles': {'1': {'positions': np.arange(5)}},
+    }}}
+    mean = np.mean(coords, axis=0, keepdims=True)
+    expected = np.sqrt(np.mean(np.linalg.norm(coords - mean, axis=-1) ** 2, axis=0))
+
+    for slab_size in [None, 1, 3, 7]:
+        (_, _, rmsds), = rmsd(nuc, slab_size=slab_size)
+        np.testing.assert_allclose(rmsds, expected, rtol=1e-10)
+
+def test_join_rmsds():
+    from nuc_analyze.rmsd import join_rmsds
+
+    nucs_rmsds = [
+        [('1', np.array([30, 10, 20]), np.array([0.1, 0.2, 0.3])),
+         ('2', np.array([10]), np.array([1.0]))],
+        [('1', np.array([10, 30, 40]), np.array([0.5, 0.0, 0.1]))],
+    ]
+    joined = join_rmsds(nucs_rmsds)
+    assert list(joined) == ['1']
+    np.testing.assert_equal(joined['1'], ([10, 30], [0.5, 0.1]))
+
+def test_rmsd_cli_structures(tmpdir):
+    from nuc_analyze.main import cli
+
+    p = tmpdir.join("test.nuc")
+    with HDFFile(p, 'w') as f:
+        for structure, nuc in zip(['0', '1'], nucs):
+            for chromo, coords in sorted(nuc['structures']['0']['coords'].items()):
+                f.create_dataset('structures/{}/coords/{}'.format(structure, chromo), data=coords)
+            for chromo, particle in nuc['structures']['0']['particles'].items():
+                f.create_dataset(
+                    'structures/{}/particles/{}/positions'.format(structure, chromo),
+                    data=particle['positions']
+                )
+
+    expected = ["0 1:10 0.0", "0 1:200 0.5", "0 X:0 1.0", "0 X:100 0.5",
+                "1 1:10 0.0", "1 1:200 0.5", "1 X:100 2.0"]
+
+    runner = CliRunner()
+    for args in [["--structure", "all"], ["--structure", "0,1", "--jobs", "2"]]:
+        result = runner.invoke(cli, ["rmsd", str(p)] + args)
+        assert result.exit_code == 0
+        assert result.output == '\n'.join(expected) + '\n'
+
+def test_rmsd_store(tmpdir):
+    from nuc_analyze.rmsd import rmsd
+
+    coords = np.random.RandomState(2).normal(size=(9, 5, 3))
+    p = str(tmpdir.join("test.nuc"))
+    with HDFFile(p, 'w') as f:
+        f.create_dataset('structures/0/coords/1', data=coords[:4], maxshape=(None, 5, 3))
+        f.create_dataset('structures/0/particles/1/positions', data=np.arange(5))
+
+    with HDFFile(p, 'r+') as f:
+        (_, _, expected), = rmsd(f)
+        (_, _, rmsds), = rmsd(f, store=True)
+        np.testing.assert_allclose(rmsds, expected, rtol=1e-10)
+        assert f['analysis/rmsd/0/1'].attrs['nmodels'] == 4
+
+        dataset = f['structures/0/coords/1']
+        dataset.resize(9, axis=0)
+        dataset[4:] = coords[4:]
+        (_, _, expected), = rmsd(f)
+        (_, _, rmsds), = rmsd(f, store=True, slab_size=2)
+        np.testing.assert_allclose(rmsds, expected, rtol=1e-10)
+        assert f['analysis/rmsd/0/1'].attrs['nmodels'] == 9
+        (_, _, rmsds), = rmsd(f, store=True)
+        np.testing.assert_allclose(rmsds, expected, rtol=1e-10)
+
+def test_rmsd_output_formats(tmpdir):
+    from nuc_analyze.main import cli
+
+    p = tmpdir.join("test.nuc")
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nucs[0]['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords)
+        for chromo, particle in nucs[0]['structures']['0']['particles'].items():
+            f.create_dataset('structures/0/particles/{}/positions'.format(chromo),
+                             data=particle['positions'])
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["rmsd", str(p), "--output-format", "csv"])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        "chromosome,position,rmsd", "1,10,0.0", "1,200,0.5", "X,0,1.0", "X,100,0.5"
+    ]
+
+    out = tmpdir.join("rmsd.npz")
+    result = runner.invoke(cli, ["rmsd", str(p), "--output-format", "npz", "--output", str(out)])
+    assert result.exit_code == 0
+    with np.load(str(out)) as data:
+        np.testing.assert_equal(data['chromosome'], ['1', '1', 'X', 'X'])
+        np.testing.assert_equal(data['position'], [10, 200, 0, 100])
+        np.testing.assert_equal(data['rmsd'], [0.0, 0.5, 1.0, 0.5])
+
+    out = tmpdir.join("rmsd.h5")
+    args = ["rmsd", str(p), "--output-format", "hdf5", "--output", str(out), "--position", "X", "0"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    with HDFFile(str(out), 'r') as f:
+        np.testing.assert_equal(f['chromosome'][:], [b'X'])
+        np.testing.assert_equal(f['position'][:], [0])
+        np.testing.assert_equal(f['rmsd'][:], [1.0])
+
+    result = runner.invoke(cli, ["rmsd", str(p), "--output-format", "npz"])
+    assert result.exit_code != 0
+
+def test_downsample():
+    from nuc_analyze.rmsd import downsample
+
+    x = np.arange(1001)
+    y = np.random.RandomState(3).normal(size=1001)
+    y[500] = 10.0
+    y[777] = -10.0
+
+    ds_x, ds_y = downsample(x, y, 100)
+    assert len(ds_x) <= 100
+    assert np.all(np.diff(ds_x) > 0)
+    np.testing.assert_equal(ds_y, y[ds_x])
+    assert {500, 777} <= set(ds_x)
+    assert ds_y.max() == y.max() and ds_y.min() == y.min()
+
+    assert downsample(x, y, 0)[0] is x
+    assert len(downsample(x[:50], y[:50], 100)[0]) == 50
+    for max_points in [1, 2, 3]:
+        ds_x, ds_y = downsample(x, y, max_points)
+        assert 1 <= len(ds_x) <= max_points
+        assert ds_y.max() == y.max()
+
+def test_plot_rmsd(tmpdir):
+    from nuc_analyze.main import cli
+
+    p = tmpdir.join("test.nuc")
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nucs[0]['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords)
+        for chromo, particle in nucs[0]['structures']['0']['particles'].items():
+            f.create_dataset('structures/0/particles/{}/positions'.format(chromo),
+                             data=particle['positions'])
+
+    out = tmpdir.join("rmsd.png")
+    result = CliRunner().invoke(cli, ["plot-rmsd", str(p), "--output", str(out), "--max-points", "2"])
+    assert result.exit_code == 0
+    assert out.check()
+
+def test_rmsd_precision():
+    from nuc_analyze.rmsd import rmsd
+
+    coords = np.random.RandomState(7).normal(size=(20, 30, 3)) + 100.0
+    nuc = {'structures': {'0': {
+        'coords': {'1': coords},
+        'particles': {'1': {'positions': np.arange(30)}},
+    }}}
+    (_, _, expected), = rmsd(nuc)
+    (_, _, rmsds), = rmsd(nuc, precision='float32')
+    # See the error bounds in kernels
+    np.testing.assert_allclose(rmsds, expected, rtol=8 * np.finfo(np.float32).eps * 200)
@@ -33,7 +33,8 @@ def test_violations():
 
 
     assert set(violations(nuc)) == {1, 4}
-    violations = violations(nuc)
+    np.testing.assert_equal(violations(nuc), [1, 4])
+    np.testing.assert_equal(violations(nuc, padding=10.0), [0, 2])
 
 def test_csv(tmpdir):
     from nuc_analyze.main import cli
@@ -66,3 +67,207 @@ def test_csv(tmpdir):
     out = iter(result.output.splitlines())
     assert next(out) == 'filename,scale_mean,scale_std,violations_mean,violations_std,foo'
     assert next(out) == ','.join(map(str, expected))
+
+    result = runner.invoke(cli, ["stats", str(p), str(p), "--param", "foo", "--jobs", "2"])
+    assert result.exit_code == 0
+    out = iter(result.output.splitlines())
+    assert next(out) == 'filename,scale_mean,scale_std,violations_mean,violations_std,foo'
+    assert next(out) == ','.join(map(str, expected))
+    assert next(out) == ','.join(map(str, expected))
+
+def test_compute_stats():
+    from nuc_analyze.stats import compute_stats, stat_kwargs
+    from math import sqrt
+
+    result = compute_stats(nuc, "0", stat_kwargs((), violation_padding=10.0))
+    assert sorted(result) == ["scale", "violations"]
+    np.testing.assert_equal(result["scale"], [0.0, sqrt(2) / 2])
+    np.testing.assert_equal(result["violations"], [0, 2])
+
+    result = compute_stats(nuc, "0", stat_kwargs(("scale",), violation_padding=0.0))
+    assert list(result) == ["scale"]
+
+def test_csv_structures(tmpdir):
+    from nuc_analyze.main import cli
+    from nuc_analyze.stats import flatten_dict
+    p = tmpdir.join("test.nuc")
+
+    with HDFFile(p, 'w') as f:
+        for structure, offset in [('0', 0), ('1', 1)]:
+            group = f.create_group('structures/{}'.format(structure))
+            for chromo, coords in nuc['structures']['0']['coords'].items():
+                group.create_dataset('coords/{}'.format(chromo), data=coords * (1 + offset))
+            flat_restraints = flatten_dict(nuc['structures']['0']['restraints'])
+            for (chr_a, chr_b), restraints in flat_restraints.items():
+                group.create_dataset('restraints/{}/{}'.format(chr_a, chr_b), data=restraints)
+            group.create_group('calculation').attrs['foo'] = offset
+
+    runner = CliRunner()
+    for jobs in ["1", "2"]:
+        args = ["stats", str(p), "--structure", "all", "--param", "foo", "--jobs", jobs]
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0
+        out = result.output.splitlines()
+        assert out[0] == 'filename,structure,scale_mean,scale_std,violations_mean,violations_std,foo'
+        assert [l.split(',')[1] for l in out[1:]] == ['0', '1']
+        assert [l.split(',')[-1] for l in out[1:]] == ['0', '1']
+
+    result = runner.invoke(cli, ["stats", str(p), "--structure", "1", "--param", "foo"])
+    assert result.exit_code == 0
+    out = result.output.splitlines()
+    assert out[0] == 'filename,scale_mean,scale_std,violations_mean,violations_std,foo'
+    assert out[1].split(',')[-1] == '1'
+
+def test_relative_violations():
+    from nuc_analyze.stats import relative_violations, violations
+    from nuc_analyze.nucfile import NucFile
+
+    relative = relative_violations(NucFile(nuc))
+    assert relative.shape == (2, 4)
+    for padding in [-0.5, 0.0, 0.5, 10.0]:
+        np.testing.assert_equal(np.count_nonzero(relative > padding, axis=1),
+                                violations(nuc, padding=padding))
+
+def test_violation_blocks():
+    from nuc_analyze.stats import relative_violations, violation_blocks
+    from nuc_analyze.nucfile import NucFile
+
+    blocks = list(violation_blocks(NucFile(nuc), block_size=1))
+    assert [b.shape for b in blocks] == [(2, 1)] * 4
+    np.testing.assert_equal(np.concatenate(blocks, axis=1), relative_violations(NucFile(nuc)))
+
+def test_restraint_violations(tmpdir):
+    from nuc_analyze.main import cli
+    from nuc_analyze.stats import flatten_dict
+    p = tmpdir.join("test.nuc")
+
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nuc['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords)
+        flat_restraints = flatten_dict(nuc['structures']['0']['restraints'])
+        for (chr_a, chr_b), restraints in flat_restraints.items():
+            f.create_dataset(
+                'structures/0/restraints/{}/{}'.format(chr_a, chr_b), data=restraints
+            )
+
+    runner = CliRunner()
+    args = ["restraint-violations", str(p), "--violation-padding", "10", "--violation-padding", "0"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    out = result.output.splitlines()
+    assert out[0] == "chr_a,chr_b,index_a,index_b,lower,upper,max_violation,violated_0.0,violated_10.0"
+    assert out[1] == "1,1,0,0,0.5,1.0,1.0,1.0,0.0"
+    assert out[2].startswith("1,1,0,1,0.0,0.1,")
+    assert out[2].endswith(",0.5,0.5")
+    assert len(out) == 5
+
+def test_compute_stats_store(tmpdir):
+    from nuc_analyze.stats import compute_stats, stat_kwargs
+    p = str(tmpdir.join("test.nuc"))
+    kwargs = stat_kwargs((), violation_padding=0.0)
+
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nuc['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords,
+                             maxshape=(None,) + coords.shape[1:])
+        f.create_dataset('structures/0/restraints/1/1',
+                         data=nuc['structures']['0']['restraints']['1']['1'])
+
+    with HDFFile(p, 'r+') as f:
+        expected = compute_stats(f, "0", kwargs)
+        result = compute_stats(f, "0", kwargs, store=True)
+        for stat in kwargs:
+            np.testing.assert_equal(result[stat], expected[stat])
+        # Stored values of existing models are reused
+        f['analysis/stats/0/scale/default/values'][0] = 5.0
+        assert compute_stats(f, "0", kwargs, store=True)['scale'][0] == 5.0
+
+        # Only appended models are computed
+        for coords in f['structures/0/coords'].values():
+            coords.resize(3, axis=0)
+            coords[2] = coords[1] * 2
+        result = compute_stats(f, "0", kwargs, store=True)
+        expected = compute_stats(f, "0", kwargs)
+        np.testing.assert_equal(result['scale'][0], 5.0)
+        np.testing.assert_equal(result['scale'][1:], expected['scale'][1:])
+        np.testing.assert_equal(result['violations'], expected['violations'])
+        assert f['analysis/stats/0/violations/padding=0.0'].attrs['nmodels'] == 3
+
+        # Changed models invalidate stored values
+        f['structures/0/coords/1'][0] += 1
+        result = compute_stats(f, "0", kwargs, store=True)
+        np.testing.assert_equal(result['scale'], compute_stats(f, "0", kwargs)['scale'])
+
+def test_stats_output_formats(tmpdir):
+    from nuc_analyze.main import cli
+    from math import sqrt
+    p = tmpdir.join("test.nuc")
+
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nuc['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords)
+        f.create_group('structures/0/calculation').attrs['foo'] = 3
+
+    out = tmpdir.join("stats.npz")
+    runner = CliRunner()
+    args = ["stats", str(p), str(p), "--stat", "scale", "--param", "foo",
+            "--output-format", "npz", "--output", str(out)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    with np.load(str(out)) as data:
+        assert list(data) == ['filename', 'scale_mean', 'scale_std', 'foo']
+        np.testing.assert_equal(data['filename'], ['test.nuc', 'test.nuc'])
+        np.testing.assert_allclose(data['scale_mean'], [sqrt(2) / 4] * 2)
+        np.testing.assert_equal(data['foo'], [3, 3])
+
+def test_store_read_only(tmpdir):
+    import os
+    from nuc_analyze.stats import file_stats, stat_kwargs
+    p = str(tmpdir.join("test.nuc"))
+    kwargs = stat_kwargs(("scale",))
+
+    with HDFFile(p, 'w') as f:
+        for chromo, coords in nuc['structures']['0']['coords'].items():
+            f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords,
+                             maxshape=(None,) + coords.shape[1:])
+        f.create_group('structures/0/calculation')
+
+    (_, _, expected), = file_stats(p, ("0",), (), kwargs, store=True)
+    mtime = os.stat(p).st_mtime_ns
+    # Up-to-date stored values are read without opening the file to write
+    (_, _, result), = file_stats(p, ("0",), (), kwargs, store=True)
+    np.testing.assert_equal(result['scale'], expected['scale'])
+    assert os.stat(p).st_mtime_ns == mtime
+
+    with HDFFile(p, 'r+') as f:
+        for coords in f['structures/0/coords'].values():
+            coords.resize(3, axis=0)
+    (_, _, result), = file_stats(p, ("0",), (), kwargs, store=True)
+    assert len(result['scale']) == 3
+    with HDFFile(p, 'r') as f:
+        assert f['analysis/stats/0/scale/default'].attrs['nmodels'] == 3
+
+def test_csv_params(tmpdir):
+    from nuc_analyze.main import cli
+    files = [tmpdir.join("a.nuc"), tmpdir.join("b.nuc")]
+
+    for p, foo, bar in zip(files, [1, 0.5], [np.array([1, 2, 3]), np.array([4, 5])]):
+        with HDFFile(p, 'w') as f:
+            for chromo, coords in nuc['structures']['0']['coords'].items():
+                f.create_dataset('structures/0/coords/{}'.format(chromo), data=coords)
+            calculation = f.create_group('structures/0/calculation')
+            calculation.attrs['foo'] = foo
+            calculation.attrs['bar'] = bar
+
+    runner = CliRunner()
+    args = (["stats"] + list(map(str, files))
+            + ["--stat", "scale", "--param", "foo", "--param", "bar"])
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    rows = result.output.splitlines()[1:]
+    assert [l.split(',', 3)[3] for l in rows] == ['1,[1 2 3]', '0.5,[4 5]']
+
+    output = str(tmpdir.join("x.npz"))
+    result = runner.invoke(cli, args + ["--output-format", "npz", "--output", output])
+    assert result.exit_code != 0
+    assert "bar" in result.output
@@ -0,0 +1,92 @@
+import json
+import numpy as np
+from h5py import File as HDFFile
+from click.testing import CliRunner
+
+from nuc_analyze import timings
+
+def test_disabled():
+    assert timings.active is None
+    with timings.stage("foo"), timings.file("bar"):
+        pass
+    assert timings.active is None
+
+def test_stages():
+    t = timings.enable()
+    try:
+        with timings.stage("outer"):
+            with timings.file("test.nuc"), timings.stage("inner"):
+                pass
+            with timings.file("test.nuc"), timings.stage("inner"):
+                pass
+    finally:
+        timings.disable()
+    assert timings.active is None
+
+    report = t.report()
+    assert set(report['total']) == {'outer', 'outer/inner'}
+    assert report['total']['outer/inner']['calls'] == 2
+    assert list(report['files']) == ['test.nuc']
+    assert list(report['files']['test.nuc']) == ['outer/inner']
+
+def test_read_bytes(tmpdir):
+    data = tmpdir.join("data")
+    data.write_binary(bytes(10000))
+    t = timings.enable()
+    try:
+        with timings.stage("outer"):
+            with timings.stage("none"):
+                pass
+            with timings.stage("read"):
+                data.read_binary()
+    finally:
+        timings.disable()
+
+    total = t.report()['total']
+    # Not counting reading /proc to take the measurements
+    assert total['outer/none']['read_bytes'] == 0
+    if timings.read_bytes():
+        assert total['outer/read']['read_bytes'] == 10000
+        assert total['outer']['read_bytes'] == 10000
+
+def test_stage_memory():
+    t = timings.enable()
+    try:
+        with timings.stage("outer"):
+            with timings.stage("large"):
+                a = np.ones(2 ** 24)
+                del a
+            with timings.stage("small"):
+                a = np.ones(2 ** 22)
+                del a
+    finally:
+        timings.disable()
+
+    total = t.report()['total']
+    assert total['outer/large']['rss_increase'] >= 0.9 * 2 ** 27
+    assert total['outer']['rss_increase'] >= total['outer/large']['rss_increase']
+    if timings.reset_peak_rss():
+        # Measured from the start of the stage, not the process's earlier peak
+        assert 0.9 * 2 ** 25 <= total['outer/small']['rss_increase'] < 2 ** 26
+
+def test_timings_cli(tmpdir):
+    from nuc_analyze.main import cli
+
+    nuc = tmpdir.join("test.nuc")
+    with HDFFile(str(nuc), 'w') as f:
+        f.create_dataset('structures/0/coords/1', data=np.array(
+            [[[0, 0, 0], [0, 0, 0]], [[0, 0, 0], [1, 0, 0]]]
+        ))
+        f.create_dataset('structures/0/particles/1/positions', data=np.array([10, 200]))
+    output = tmpdir.join("timings.json")
+
+    runner = CliRunner()
+    for jobs in ["1", "2"]:
+        result = runner.invoke(cli, ["--timings", str(output), "rmsd", "--jobs", jobs, str(nuc)])
+        assert result.exit_code == 0
+        assert timings.active is None
+
+        with output.open() as f:
+            report = json.load(f)
+        assert set(report['files'][str(nuc)]) == {'read', 'rmsd', 'rmsd/read'}
+        assert {'join', 'output'} <= set(report['total'])
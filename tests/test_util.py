@@ -17,3 +17,8 @@ def test_unflatten_dict():
 def test_ceil_div():
     assert ceil_div(4, 2) == 2
     assert ceil_div(5, 2) == 3
+
+
+def test_parallel_map():
+    assert list(parallel_map(abs, [-3, 2, -1])) == [3, 2, 1]
+    assert list(parallel_map(abs, [-3, 2, -1], jobs=2)) == [3, 2, 1]